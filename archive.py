@@ -0,0 +1,450 @@
+"""Archive engines
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import stat
+import time
+import zlib
+import shutil
+import struct
+import tarfile
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# zstd compression is only available when the optional zstandard binding is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATS = ('zip', 'tar.gz', 'tar.xz', 'tar.zst')
+STORED = 0
+DEFLATED = 8
+# Files with these extensions are already compressed, deflating them again is a waste of CPU time
+INCOMPRESSIBLE = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.jar',
+    '.woff', '.woff2', '.mp3', '.mp4', '.ogg', '.webm'
+}
+CHUNK_SIZE = 1024 * 1024
+# Compressed members bigger than this are spooled to disk until the writer gets to them
+SPOOL_SIZE = 4 * 1024 * 1024
+# Members compressed ahead of the writer hold at most this much memory, see ParallelZip
+WINDOW_BYTES = 32 * 1024 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+
+class MemberError(Exception):
+    """Raised when a member couldn't be added to the archive"""
+
+    def __init__(self, arcname, exc):
+        super().__init__(str(exc))
+        self.arcname = arcname
+
+
+def dos_datetime(mtime):
+    """Converts a timestamp to the MS-DOS date and time format used in zip headers
+    :param mtime: number, a timestamp
+    :return: A (date, time) tuple
+    """
+    year, month, day, hour, minute, second = time.localtime(mtime)[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+
+def zip_datetime(date_time):
+    """
+    :param date_time: the date_time tuple of a zipfile.ZipInfo
+    :return: The same (date, time) tuple as dos_datetime()
+    """
+    year, month, day, hour, minute, second = date_time
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+
+def compress_method(path, level):
+    """
+    :return: STORED if the file isn't worth compressing at this level, DEFLATED otherwise
+    """
+    return DEFLATED if level and os.path.splitext(path)[1].lower() not in INCOMPRESSIBLE else STORED
+
+
+def find_previous(archive_path):
+    """Finds the newest earlier zip archive of a project, stored in the same folder as the new one
+    :param archive_path: text, the location of the new archive, e.g. /backups/project_171026073518.zip
+    :return: The path of the previous archive, or None if there is none
+    """
+    parent, name = os.path.split(archive_path)
+    project = name[:-len('.zip')].rpartition('_')[0]
+    candidates = []
+    try:
+        entries = list(os.scandir(parent))
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.name.endswith('.zip') or entry.path == archive_path or not entry.is_file():
+            continue
+        prefix, _, stamp = entry.name[:-len('.zip')].rpartition('_')
+        if prefix != project:
+            continue
+        try:
+            taken = time.strptime(stamp, '%d%m%y%H%M%S')
+        except ValueError:
+            continue
+        candidates.append((taken, entry.path))
+    return max(candidates)[1] if candidates else None
+
+
+def compress_file(path, level):
+    """Compresses a file on its own, so that it can be done by any worker
+    :param path: text, the file we want to compress
+    :param level: number, the zlib compression level. 0 means the file is stored as is
+    :return: A (method, crc, size, compressed data) tuple, the data being a file object positioned at 0
+    """
+    method = compress_method(path, level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if method == DEFLATED else None
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    crc = size = 0
+    with open(path, 'rb') as read_file:
+        while True:
+            chunk = read_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            data.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        data.write(compressor.flush())
+    data.seek(0)
+    return method, crc, size, data
+
+
+def check_file(path, level, info):
+    """Compares a file with its member in the previous archive, which is only reused when their CRCs are equal.
+    Computing the CRC is much cheaper than compressing the file
+    :param path: text, the file we want to archive
+    :param level: number, the zlib compression level, used if the file has to be compressed
+    :param info: zipfile.ZipInfo of the member of the previous archive
+    :return: The same tuple as compress_file, the data being None when the previous member is reused
+    """
+    crc = 0
+    with open(path, 'rb') as read_file:
+        for chunk in iter(lambda: read_file.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    if crc == info.CRC:
+        return info.compress_type, crc, info.file_size, None
+    return compress_file(path, level)
+
+
+class ParallelZip:
+    """Zip writer that compresses the members on a pool of threads (zlib releases the GIL)
+    while a single writer appends them to the archive in the order they were submitted.
+    The output is a standard zip file, with zip64 extensions only when they are needed.
+    The members compressed ahead of the writer are kept in memory up to SPOOL_SIZE each, the rest going to disk.
+    The sizes of their files, each capped at SPOOL_SIZE, add up to at most window_bytes, so an archive holds about
+    window_bytes + SPOOL_SIZE of compressed data in memory (36MB by default) whatever the number of threads.
+    A --jobs batch multiplies it by its number of jobs.
+    """
+
+    def __init__(self, path, level=9, threads=None, window=None, window_bytes=WINDOW_BYTES):
+        """
+        :param path: text, the location of the archive
+        :param level: number, the compression level, from 0 (stored) to 9
+        :param threads: (optional) number of compression threads, defaults to the number of CPUs
+        :param window: (optional) number of members that can be compressed ahead of the writer
+        :param window_bytes: (optional) memory the members compressed ahead of the writer may hold, in bytes
+        """
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.window = window or self.threads * 4
+        self.window_bytes = window_bytes
+        # Memory that the pending members may hold, each one counting for its size, capped at SPOOL_SIZE
+        self.pending_bytes = 0
+        self.fp = open(path, 'wb')
+        self.entries = []
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        # Members of the previous archive of the project, see reuse()
+        self.previous = {}
+        self.previous_fp = None
+        self.reused = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.fp.close()
+            if self.previous_fp:
+                self.previous_fp.close()
+        else:
+            self.close()
+
+    def reuse(self, path):
+        """The files that didn't change since a previous archive are not compressed again,
+        their compressed data is copied from it
+        :param path: text, the previous zip archive
+        :raise OSError: if the previous archive can't be opened
+        :raise ValueError: if it isn't a valid zip archive
+        """
+        import zipfile
+        previous_fp = open(path, 'rb')
+        try:
+            with zipfile.ZipFile(previous_fp) as previous:
+                self.previous = {info.filename: info for info in previous.infolist()}
+        except zipfile.BadZipFile as exc:
+            previous_fp.close()
+            raise ValueError(str(exc)) from exc
+        self.previous_fp = previous_fp
+
+    def write(self, path, arcname, on_done=None, st=None):
+        """Adds a file, a folder or a symbolic link to the archive
+        :param path: text, the location of the element on the disk
+        :param arcname: text, the name of the element within the archive
+        :param on_done: (optional) function called once the member has been written
+        :param st: (optional) the os.lstat() result of the element, if the caller already has it
+        """
+        st = st or os.lstat(path)
+        spooled = 0
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(path).encode()
+            member = (STORED, zlib.crc32(target), len(target), target)
+        elif stat.S_ISDIR(st.st_mode):
+            arcname = f'{arcname.rstrip("/")}/'
+            member = (STORED, 0, 0, b'')
+        else:
+            spooled = min(st.st_size, SPOOL_SIZE)
+            info = self.previous.get(arcname)
+            # Only the CRC of the file is computed when its size, modification time and compression method are the
+            # same as in the previous archive
+            if info and info.file_size == st.st_size and zip_datetime(info.date_time) == dos_datetime(st.st_mtime) \
+                    and info.compress_type == compress_method(path, self.level):
+                member = self.executor.submit(check_file, path, self.level, info)
+            else:
+                member = self.executor.submit(compress_file, path, self.level)
+        self.pending.append((arcname, st, member, on_done, spooled))
+        self.pending_bytes += spooled
+        while len(self.pending) > self.window or (self.pending_bytes > self.window_bytes and len(self.pending) > 1):
+            self._flush_one()
+
+    def splice(self, path, prefix=''):
+        """Copies the members of another zip archive as they are, without decompressing and compressing them again
+        :param path: text, the zip archive
+        :param prefix: (optional) text, only the members whose name starts with it are copied
+        :return: The list of the zipfile.ZipInfo of the members that have been copied
+        """
+        import zipfile
+        # The members submitted before are written first, so that the archive keeps the order of the calls
+        while self.pending:
+            self._flush_one()
+        copied = []
+        with open(path, 'rb') as read_archive, zipfile.ZipFile(read_archive) as source:
+            for info in source.infolist():
+                if not info.filename.startswith(prefix):
+                    continue
+                date, dos_time = zip_datetime(info.date_time)
+                self._write_member(
+                    info.filename.encode(), info.compress_type, dos_time, date, info.CRC, info.compress_size,
+                    info.file_size, info.external_attr, lambda: self._copy_raw(read_archive, info)
+                )
+                copied.append(info)
+        return copied
+
+    def close(self):
+        """Writes the remaining members, then the central directory"""
+        try:
+            while self.pending:
+                self._flush_one()
+            self._write_central_directory()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.fp.close()
+            if self.previous_fp:
+                self.previous_fp.close()
+
+    def _flush_one(self):
+        arcname, st, member, on_done, spooled = self.pending.popleft()
+        self.pending_bytes -= spooled
+        try:
+            method, crc, size, data = member if isinstance(member, tuple) else member.result()
+        except Exception as exc:
+            raise MemberError(arcname, exc) from exc
+        if data is None:
+            # Unchanged since the previous archive, its member is copied as is
+            info = self.previous[arcname]
+            date, dos_time = dos_datetime(st.st_mtime)
+            self._write_member(arcname.encode(), method, dos_time, date, crc, info.compress_size, size,
+                               (st.st_mode & 0xFFFF) << 16, lambda: self._copy_raw(self.previous_fp, info))
+            self.reused += 1
+            if on_done:
+                on_done()
+            return
+        if isinstance(data, bytes):
+            compressed_size = len(data)
+        else:
+            data.seek(0, os.SEEK_END)
+            compressed_size = data.tell()
+            data.seek(0)
+        date, dos_time = dos_datetime(st.st_mtime)
+        external_attr = (st.st_mode & 0xFFFF) << 16
+        if stat.S_ISDIR(st.st_mode):
+            external_attr |= 0x10
+
+        def write_data():
+            if isinstance(data, bytes):
+                self.fp.write(data)
+            else:
+                with data:
+                    shutil.copyfileobj(data, self.fp, CHUNK_SIZE)
+        self._write_member(arcname.encode(), method, dos_time, date, crc, compressed_size, size, external_attr,
+                           write_data)
+        if on_done:
+            on_done()
+
+    def _write_member(self, name, method, dos_time, date, crc, compressed_size, size, external_attr, write_data):
+        offset = self.fp.tell()
+        zip64 = size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 1, 16, size, compressed_size) if zip64 else b''
+        self.fp.write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, 0x800, method, dos_time, date, crc,
+            ZIP64_LIMIT if zip64 else compressed_size, ZIP64_LIMIT if zip64 else size, len(name), len(extra)
+        ))
+        self.fp.write(name)
+        self.fp.write(extra)
+        write_data()
+        self.entries.append((name, method, dos_time, date, crc, compressed_size, size, external_attr, offset))
+
+    def _copy_raw(self, fp, info):
+        fp.seek(info.header_offset)
+        header = fp.read(30)
+        if header[:4] != b'PK\x03\x04':
+            raise MemberError(info.filename, 'bad local header')
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        fp.seek(info.header_offset + 30 + name_length + extra_length)
+        length = info.compress_size
+        while length:
+            chunk = fp.read(min(length, CHUNK_SIZE))
+            if not chunk:
+                raise EOFError('truncated zip member')
+            self.fp.write(chunk)
+            length -= len(chunk)
+
+    def _write_central_directory(self):
+        start = self.fp.tell()
+        for name, method, dos_time, date, crc, compressed_size, size, external_attr, offset in self.entries:
+            zip64_fields = []
+            if size >= ZIP64_LIMIT:
+                zip64_fields.append(size)
+            if compressed_size >= ZIP64_LIMIT:
+                zip64_fields.append(compressed_size)
+            if offset >= ZIP64_LIMIT:
+                zip64_fields.append(offset)
+            extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields) \
+                if zip64_fields else b''
+            version = 45 if zip64_fields else 20
+            self.fp.write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version, 0x800, method, dos_time, date, crc,
+                min(compressed_size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(name), len(extra), 0, 0, 0,
+                external_attr, min(offset, ZIP64_LIMIT)
+            ))
+            self.fp.write(name)
+            self.fp.write(extra)
+        end = self.fp.tell()
+        count = len(self.entries)
+        size = end - start
+        if count > ZIP_FILECOUNT_LIMIT or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            # Zip64 end of central directory record, then its locator
+            self.fp.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, size, start))
+            self.fp.write(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+        self.fp.write(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, ZIP_FILECOUNT_LIMIT), min(count, ZIP_FILECOUNT_LIMIT),
+            min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0
+        ))
+
+
+class TarWriter:
+    """Solid tar archive, compressed as a single stream. Symbolic links and modes are kept natively"""
+
+    def __init__(self, path, compression, level=9):
+        """
+        :param path: text, the location of the archive
+        :param compression: text, one of 'gz', 'xz' or 'zst'
+        :param level: number, the compression level, from 0 to 9
+        """
+        self.stream = None
+        # The file is opened here rather than by tarfile, so that abort() can close it before the end of the streams
+        self.fp = open(path, 'wb')
+        if compression == 'zst':
+            self.stream = zstandard.ZstdCompressor(level=level).stream_writer(self.fp)
+            self.tar = tarfile.open(fileobj=self.stream, mode='w|', format=tarfile.PAX_FORMAT)
+        elif compression == 'xz':
+            self.tar = tarfile.open(path, 'w:xz', fileobj=self.fp, preset=level, format=tarfile.PAX_FORMAT)
+        else:
+            self.tar = tarfile.open(path, 'w:gz', fileobj=self.fp, compresslevel=level, format=tarfile.PAX_FORMAT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, path, arcname, on_done=None, st=None):
+        """Adds a file, a folder or a symbolic link to the archive
+        :param path: text, the location of the element on the disk
+        :param arcname: text, the name of the element within the archive
+        :param on_done: (optional) function called once the member has been written
+        :param st: (optional) unused, tarfile does its own lstat
+        """
+        try:
+            self.tar.add(path, arcname=arcname, recursive=False)
+        except Exception as exc:
+            raise MemberError(arcname, exc) from exc
+        if on_done:
+            on_done()
+
+    def close(self):
+        """Finishes the tar stream, then the compressed stream"""
+        try:
+            self.tar.close()
+        finally:
+            if self.stream:
+                self.stream.close()
+            if not self.fp.closed:
+                self.fp.close()
+
+    def abort(self):
+        """Closes the file without writing the end of the tar and compressed streams,
+        so that an interrupted archive can't be mistaken for a complete one"""
+        self.fp.close()
+        # Whatever the streams still had to write fails on the closed file
+        try:
+            self.tar.close()
+        except (OSError, ValueError):
+            pass
+        if self.stream:
+            try:
+                self.stream.close()
+            except (OSError, ValueError):
+                pass
+
+
+def open_archive(path, fmt='zip', level=9):
+    """Opens the archive engine corresponding to a format
+    :param path: text, the location of the archive, extension included
+    :param fmt: text, one of FORMATS
+    :param level: number, the compression level, from 0 to 9
+    :return: An archive writer, to be used as a context manager
+    """
+    if fmt == 'zip':
+        return ParallelZip(path, level)
+    if fmt == 'tar.zst' and not zstandard:
+        raise RuntimeError('tar.zst archives require the zstandard package (pip install zstandard)')
+    return TarWriter(path, fmt.split('.')[1], level)
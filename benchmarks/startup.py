@@ -0,0 +1,99 @@
+"""Checks that shlerp starts fast: the time it takes to import main.py stays within a budget,
+and the modules of the archive, copy and store code paths are only imported when they are used
+Usage: python benchmarks/startup.py [--budget-ms 40] [--runs 10]
+Exits with 1 when the budget is exceeded, so that it can be used as a check before merging.
+The budget only covers what shlerp adds to an interpreter that imports click: click alone takes about 50ms,
+which would make an absolute budget depend on the machine more than on the code
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# Maximum time that importing main.py adds to importing click, in milliseconds
+BUDGET_MS = 40
+# Neither of these should be imported before a backup actually starts
+LAZY_MODULES = (
+    'archive', 'copier', 'snapshot', 'store', 'depcache', 'journal', 'zipfile', 'tarfile', 'shutil', 'tempfile',
+    'subprocess', 'uuid', 'random', 'concurrent.futures', 'multiprocessing'
+)
+
+
+def run(code, *flags):
+    """
+    :return: The wall time of a new interpreter running the code, and its standard output and error
+    """
+    started = time.perf_counter()
+    done = subprocess.run([sys.executable, *flags, '-c', code], cwd=REPO, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if done.returncode:
+        print(done.stderr)
+        sys.exit(1)
+    return elapsed, done.stdout, done.stderr
+
+
+def slowest_imports(stderr, count=10):
+    """
+    :param stderr: the output of python -X importtime
+    :return: The lines of the modules that took the longest to import, cumulatively
+    """
+    timings = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative), name.strip()))
+    return [f'{cumulative / 1000:>8.1f}ms  {name}' for cumulative, name in sorted(timings, reverse=True)[:count]]
+
+
+def measure(runs):
+    """Times new interpreters, the fastest of the runs being kept
+    :param runs: number, how many interpreters are started for each measure
+    :return: A dictionary with the time of an interpreter alone, with click, and with main.py, in seconds,
+    and the names of the modules imported by main.py but not by click
+    """
+    # The first run compiles the bytecode, which only happens once after an installation
+    run('import main')
+    _, loaded, _ = run('import sys, main; print("\\n".join(sys.modules))')
+    _, by_click, _ = run('import sys, click; print("\\n".join(sys.modules))')
+    return {
+        'interpreter': min(run('pass')[0] for _ in range(runs)),
+        'click': min(run('import click')[0] for _ in range(runs)),
+        'main': min(run('import main')[0] for _ in range(runs)),
+        'modules': set(loaded.split()) - set(by_click.split())
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS,
+                        help='maximum time that importing main.py adds to importing click')
+    parser.add_argument('--runs', type=int, default=10, help='the fastest run is compared with the budget')
+    args = parser.parse_args()
+
+    measures = measure(args.runs)
+    _, _, importtime = run('import main', '-X', 'importtime')
+    eager = sorted(name for name in LAZY_MODULES if name in measures['modules'])
+    added = measures['main'] - measures['click']
+    print(f'Interpreter alone: {measures["interpreter"] * 1000:.1f}ms - With click: {measures["click"] * 1000:.1f}ms '
+          f'- With main.py: {measures["main"] * 1000:.1f}ms, {added * 1000:.1f}ms more than click '
+          f'(budget: {args.budget_ms:.0f}ms)')
+    print('Slowest imports:')
+    for line in slowest_imports(importtime):
+        print(line)
+
+    failed = False
+    if eager:
+        print(f'Imported at startup but only needed by some code paths: {", ".join(eager)}')
+        failed = True
+    if added * 1000 > args.budget_ms:
+        print('Startup budget exceeded')
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""Times the detection and backup stages of shlerp against synthetic projects
+Usage: python benchmarks/suite.py [--files 10000] [--kinds js,python,polyglot,symlinks] [--repeat 5]
+                                  [--output results.json] [--baseline baseline.json] [--tolerance 0.2]
+Save the results of a run with --output, then pass them as --baseline to later runs: the script exits with 1
+when a stage got slower than the baseline by more than the tolerance. Each stage is run --repeat times and
+its fastest run is the one compared, a single cold run being too noisy
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils  # noqa: E402
+import main  # noqa: E402
+import ruleset as rules_index  # noqa: E402
+from state import StateStore  # noqa: E402
+from logs import LOG  # noqa: E402
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+KINDS = ('js', 'python', 'polyglot', 'symlinks')
+# Text rather than random bytes, so that the archives have something to compress
+FILLER = b'const shlerp = require("shlerp"); // backing up the projects since 2023\n'
+
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as write_data:
+        write_data.write((FILLER * (size // len(FILLER) + 1))[:size])
+
+
+def spread(root, count, size, ext, per_folder=50, depth=3):
+    """Writes files across a tree of folders, a tenth of them being hidden"""
+    for index in range(count):
+        folder = os.path.join(root, *[f'd{(index // per_folder) % (10 ** (level + 1))}' for level in range(depth)])
+        write_file(os.path.join(folder, f'{"." if index % 10 == 0 else ""}f{index}{ext}'), size)
+
+
+def make_js(root, files, size):
+    """A JS project whose node_modules holds most of the files, nested several packages deep"""
+    write_file(f'{root}/package.json', 64)
+    write_file(f'{root}/package-lock.json', 256)
+    write_file(f'{root}/tsconfig.json', 64)
+    spread(f'{root}/src', files // 5, size, '.js')
+    modules = files - files // 5
+    for package in range(max(modules // 100, 1)):
+        nested = f'{root}/node_modules/pkg{package}/node_modules/dep{package % 7}/node_modules/sub{package % 3}'
+        spread(nested, min(100, modules), size, '.js', per_folder=20, depth=1)
+
+
+def make_python(root, files, size):
+    """A Python project with its virtual environment"""
+    write_file(f'{root}/setup.py', 64)
+    write_file(f'{root}/requirements.txt', 64)
+    write_file(f'{root}/venv/pyvenv.cfg', 64)
+    spread(f'{root}/package', files // 4, size, '.py')
+    spread(f'{root}/venv/lib/python3.11/site-packages', files - files // 4, size, '.py', per_folder=100)
+
+
+def make_polyglot(root, files, size):
+    """A monorepo with several languages, none of them having its marker files at the root"""
+    share = files // 4
+    for name, ext in (('web', '.ts'), ('api', '.py'), ('tools', '.java'), ('docs', '.md')):
+        spread(f'{root}/packages/{name}', share, size, ext)
+    write_file(f'{root}/packages/web/package.json', 64)
+
+
+def make_symlinks(root, files, size):
+    """A JS project where half of the entries are symbolic links to files and folders"""
+    write_file(f'{root}/package.json', 64)
+    spread(f'{root}/src', files // 2, size, '.js')
+    os.makedirs(f'{root}/links')
+    targets = sorted(os.path.join(folder, name) for folder, _, names in os.walk(f'{root}/src') for name in names)
+    for index in range(files // 2):
+        if index % 50 == 0:
+            target = os.path.dirname(targets[index % len(targets)])
+        else:
+            target = targets[index % len(targets)]
+        os.symlink(os.path.relpath(target, f'{root}/links'), f'{root}/links/l{index}')
+
+
+GENERATORS = {'js': make_js, 'python': make_python, 'polyglot': make_polyglot, 'symlinks': make_symlinks}
+
+
+def project_size(proj_fld):
+    """
+    :return: The number of elements of the project, and the size of its regular files
+    """
+    count = size = 0
+    for _, entry in utils.walk_hidden(proj_fld):
+        count += 1
+        if entry.is_file(follow_symlinks=False):
+            size += entry.stat(follow_symlinks=False).st_size
+    return count, size
+
+
+def peak_rss():
+    """
+    :return: The peak resident set size of the process, in KiB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def timed(repeat, func, *args, reset=None):
+    """Runs a stage several times with its messages muted
+    :param repeat: number of runs of the stage
+    :param reset: (optional) function called after each run, outside of the measures, e.g. to remove its output
+    :return: The result of the last run, and the measures of the fastest one along with the median time
+    """
+    runs = []
+    result = None
+    for _ in range(repeat):
+        cpu = time.process_time()
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = func(*args)
+        runs.append((time.perf_counter() - started, time.process_time() - cpu))
+        if reset:
+            reset()
+    runs.sort()
+    return result, {
+        'seconds': runs[0][0],
+        'median_seconds': runs[len(runs) // 2][0],
+        'cpu_seconds': runs[0][1],
+        'peak_rss_kb': peak_rss()
+    }
+
+
+def run_project(kind, proj_fld, work, ruleset, settings, options, repeat):
+    """Times every stage against a single generated project
+    :param repeat: number of runs of each stage
+    :return: A dictionary mapping the names of the stages to their measures
+    """
+    count, size = project_size(proj_fld)
+    uid = utils.suid()
+    results = {}
+
+    _, results['rules_load'] = timed(repeat, rules_index.load, f'{REPO}/rules.json')
+    state = StateStore(f'{work}/state_{kind}.json')
+    detected, results['detect'] = timed(repeat, main.auto_detect, proj_fld, ruleset, settings, state, uid)
+    _, results['crawl'] = timed(repeat, utils.crawl_for_weight, proj_fld, ruleset.score(proj_fld, ruleset.names),
+                                ruleset.dep_folders)
+    # Projects that can't be detected are still backed up, with the first rule of the ruleset
+    rule = detected or ruleset.get(ruleset.names[0])
+    matcher = utils.ExclusionMatcher(rule['actions']['exclude'], options, exclude_dep=not options['noexcl'])
+    _, results['get_files'] = timed(repeat, utils.get_files, proj_fld, matcher)
+    # The backups are removed after each run, so that every run writes to the same destination
+    copy_dst = f'{work}/{kind}_copy'
+    _, results['duplicate'] = timed(repeat, main.duplicate, proj_fld, copy_dst, rule, options, uid, time.time(), '',
+                                    reset=lambda: shutil.rmtree(copy_dst, ignore_errors=True))
+    archive_dst = f'{work}/{kind}_archive'
+    _, results['archive'] = timed(repeat, main.make_archive, proj_fld, archive_dst, rule, options, uid, time.time(),
+                                  '', reset=lambda: os.remove(f'{archive_dst}.{options["format"]}'))
+    for stage in results.values():
+        stage['files_per_s'] = count / stage['seconds'] if stage['seconds'] else None
+        stage['mb_per_s'] = size / 1024 ** 2 / stage['seconds'] if stage['seconds'] else None
+    return {'files': count, 'bytes': size, 'rule': detected['name'] if detected else None, 'stages': results}
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Prints how the stages compare with the baseline
+    :return: The list of the stages that are slower than the baseline by more than the tolerance
+    """
+    regressions = []
+    for kind, project in results['projects'].items():
+        reference = baseline.get('projects', {}).get(kind)
+        if not reference:
+            continue
+        for stage, measures in project['stages'].items():
+            before = reference['stages'].get(stage, {}).get('seconds')
+            if not before:
+                continue
+            ratio = measures['seconds'] / before
+            # Stages that are too short to be timed reliably are only displayed
+            flag = ' <- regression' if ratio > 1 + tolerance and measures['seconds'] >= min_seconds else ''
+            print(f'{kind:<10} {stage:<12} {before:>9.3f}s -> {measures["seconds"]:>9.3f}s  x{ratio:.2f}{flag}')
+            if flag:
+                regressions.append(f'{kind}/{stage}')
+    return regressions
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=10000, help='number of files per project')
+    parser.add_argument('--file-size', type=int, default=4096, help='size of the generated files, in bytes')
+    parser.add_argument('--kinds', default=','.join(KINDS), help='projects to generate, among ' + ', '.join(KINDS))
+    parser.add_argument('--format', default='zip', help='archive format')
+    parser.add_argument('--output', help='where the results are written, as json')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before failing, 0.2 = 20%%')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help="stages faster than this aren't reported as regressions")
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each stage, the fastest one is kept')
+    parser.add_argument('--keep', action='store_true', help="don't remove the generated projects")
+    args = parser.parse_args()
+    # Only the warnings and errors of the stages are printed, the results table would be lost among their messages
+    LOG.configure('quiet')
+
+    with open(f'{REPO}/settings.json', 'r') as read_settings:
+        settings = json.load(read_settings)
+    ruleset = rules_index.load(f'{REPO}/rules.json')
+    options = {
+        'dependencies': True, 'noexcl': False, 'nogit': False, 'keephidden': True, 'compress_level': 6,
+        'format': args.format, 'incremental': False, 'checksum': False, 'store': None, 'output': None,
+        'io_threads': 4, 'no_cache': True, 'respect_gitignore': False, 'git_index': False
+    }
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'files': args.files,
+            'file_size': args.file_size
+        },
+        'projects': {}
+    }
+
+    root = tempfile.mkdtemp(prefix='shlerp-bench-')
+    try:
+        for kind in args.kinds.split(','):
+            proj_fld = f'{root}/projects/{kind}'
+            work = f'{root}/work'
+            os.makedirs(work, exist_ok=True)
+            GENERATORS[kind](proj_fld, args.files, args.file_size)
+            project = results['projects'][kind] = run_project(kind, proj_fld, work, ruleset, settings, options,
+                                                               max(args.repeat, 1))
+            print(f'{kind} ({project["files"]} elements, {project["bytes"] / 1024 ** 2:.1f}MB, '
+                  f'rule: {project["rule"]})')
+            for stage, measures in project['stages'].items():
+                print(f'  {stage:<12} {measures["seconds"]:>9.3f}s {measures["cpu_seconds"]:>9.3f}s cpu '
+                      f'{measures["files_per_s"] or 0:>12.0f} files/s {measures["mb_per_s"] or 0:>9.1f} MB/s '
+                      f'{measures["peak_rss_kb"] / 1024:>8.1f}MB rss')
+    finally:
+        if args.keep:
+            print(f'Generated projects kept in {root}')
+        else:
+            shutil.rmtree(root)
+
+    if args.output:
+        with open(args.output, 'w') as write_results:
+            json.dump(results, write_results, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r') as read_baseline:
+            regressions = compare(results, json.load(read_baseline), args.tolerance, args.min_seconds)
+        if regressions:
+            print(f'Slower than the baseline: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_benchmark()
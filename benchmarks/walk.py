@@ -0,0 +1,75 @@
+"""Compares utils.walk_hidden with the glob-based iglob_hidden it replaced
+Usage: python benchmarks/walk.py [--files 100000] [--threads 4]
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils  # noqa: E402
+
+
+def iglob_hidden(*args, **kwargs):
+    """The previous implementation, kept here as the reference. It swaps glob._ishidden module-wide"""
+    old_ishidden = glob._ishidden
+    glob._ishidden = lambda x: False
+    try:
+        yield from glob.iglob(*args, **kwargs)
+    finally:
+        glob._ishidden = old_ishidden
+
+
+def make_tree(root, files, per_folder=50, depth=4):
+    """Generates a tree of empty files, a tenth of them being hidden"""
+    for index in range(files):
+        folder = os.path.join(root, *[f'd{(index // per_folder) % (10 ** (level + 1))}' for level in range(depth)])
+        os.makedirs(folder, exist_ok=True)
+        open(os.path.join(folder, f'{"." if index % 10 == 0 else ""}f{index}.txt'), 'w').close()
+
+
+def timed(label, func, *args):
+    started = time.perf_counter()
+    count = func(*args)
+    elapsed = time.perf_counter() - started
+    print(f'{label:<32} {count:>9} entries {elapsed:>8.3f}s {count / elapsed:>12.0f} entries/s')
+    return count
+
+
+def run_glob(root):
+    return sum(1 for _ in iglob_hidden(f'{root}/**', recursive=True)) - 1
+
+
+def run_walk(root):
+    return sum(1 for _ in utils.walk_hidden(root))
+
+
+def run_walk_threads(root, threads):
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return sum(executor.map(run_walk, [root] * threads))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    root = tempfile.mkdtemp(prefix='shlerp-walk-')
+    try:
+        make_tree(root, args.files)
+        glob_count = timed('iglob_hidden', run_glob, root)
+        walk_count = timed('walk_hidden', run_walk, root)
+        timed(f'walk_hidden x{args.threads} threads', run_walk_threads, root, args.threads)
+        if glob_count != walk_count:
+            print(f'Entry count mismatch: {glob_count} != {walk_count}')
+            sys.exit(1)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
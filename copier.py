@@ -0,0 +1,289 @@
+"""Copy engine
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import sys
+import errno
+import queue
+import shutil
+import threading
+from os.path import join
+from profiler import PROFILE
+from logs import LOG
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int), clones a whole file on btrfs, XFS and other copy-on-write filesystems
+FICLONE = 0x40049409
+# The kernel or the filesystem doesn't support the strategy, the next one has to be used for the rest of the run
+UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.ENOSYS}
+# The strategy can't copy this file (another device, a special file...), the next one is only used for this file
+NOT_APPLICABLE = {errno.EXDEV, errno.EINVAL, errno.EBADF}
+STRATEGIES = ('reflink', 'copy_file_range', 'sendfile', 'buffered')
+MAX_CHUNK = 1024 * 1024 * 1024
+
+
+class CopyEngine:
+    """Copies files with the fastest strategy available: a reflink, then copy_file_range, then sendfile
+    and finally a buffered copy. A strategy that isn't supported is not tried again for the rest of the run,
+    one that only fails for a file is still used for the next ones"""
+
+    def __init__(self):
+        self.enabled = {
+            'reflink': bool(fcntl) and sys.platform.startswith('linux'),
+            'copy_file_range': hasattr(os, 'copy_file_range'),
+            'sendfile': hasattr(os, 'sendfile') and sys.platform.startswith('linux'),
+            'buffered': True
+        }
+        self.used = dict.fromkeys(('hardlink',) + STRATEGIES, 0)
+        # The engine is shared by the threads of a CopyPipeline
+        self.lock = threading.Lock()
+
+    def copyfile(self, src, dst):
+        """Copies the content of a file, with the same signature as shutil.copyfile
+        :param src: text, the source file
+        :param dst: text, the destination file
+        :return: The destination file
+        """
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            for strategy in STRATEGIES:
+                if not self.enabled[strategy]:
+                    continue
+                try:
+                    getattr(self, f'_{strategy}')(fsrc, fdst, size)
+                except OSError as exc:
+                    if exc.errno not in UNSUPPORTED | NOT_APPLICABLE or strategy == 'buffered':
+                        raise
+                    if exc.errno in UNSUPPORTED:
+                        with self.lock:
+                            self.enabled[strategy] = False
+                    # Whatever may have been written by the failed strategy is discarded
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                    continue
+                with self.lock:
+                    self.used[strategy] += 1
+                PROFILE.count('copy', 'files_copied')
+                PROFILE.count('copy', 'bytes_written', size)
+                LOG.advance(1, size)
+                break
+        return dst
+
+    def copy(self, src, dst):
+        """Same as shutil.copy: copies the content and the permission bits"""
+        self.copyfile(src, dst)
+        shutil.copymode(src, dst)
+        return dst
+
+    def copy2(self, src, dst):
+        """Same as shutil.copy2: copies the content and the metadata, used as the copy_function of shutil.copytree"""
+        self.copyfile(src, dst)
+        shutil.copystat(src, dst)
+        return dst
+
+    def link(self, src, dst):
+        """Hardlinks a file that is already part of a backup, or copies it like copy2 when it can't be linked
+        :param src: text, the file to link
+        :param dst: text, the destination file
+        :return: The destination file
+        """
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Another device, or too many links to the file
+            return self.copy2(src, dst)
+        with self.lock:
+            self.used['hardlink'] += 1
+        PROFILE.count('copy', 'files_linked')
+        LOG.advance(1, os.lstat(dst).st_size)
+        return dst
+
+    def report(self):
+        """
+        :return: A string listing how many files were copied with each strategy
+        """
+        return ' - '.join(f'{strategy}: {count}' for strategy, count in self.used.items() if count)
+
+    @staticmethod
+    def _reflink(fsrc, fdst, size):
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+    @staticmethod
+    def _short_copy(copied, size):
+        # Some filesystems make copy_file_range return 0 before the end of the file, and the file may have shrunk:
+        # the buffered copy is left to copy whatever is there
+        if copied < size:
+            raise OSError(errno.EINVAL, f'Only {copied} of {size} bytes could be copied')
+
+    @staticmethod
+    def _copy_file_range(fsrc, fdst, size):
+        copied = 0
+        while copied < size:
+            sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(size - copied, MAX_CHUNK))
+            if sent == 0:
+                break
+            copied += sent
+        CopyEngine._short_copy(copied, size)
+
+    @staticmethod
+    def _sendfile(fsrc, fdst, size):
+        copied = 0
+        while copied < size:
+            sent = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, min(size - copied, MAX_CHUNK))
+            if sent == 0:
+                break
+            copied += sent
+        CopyEngine._short_copy(copied, size)
+
+    @staticmethod
+    def _buffered(fsrc, fdst, size):
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+class CopyPipeline:
+    """Copies files on a pool of threads, fed through a bounded queue by a single producer that walks the
+    source trees and creates the folders. The errors are collected instead of aborting the whole copy"""
+
+    def __init__(self, threads=4, queue_size=None, resume=False):
+        """
+        :param threads: number of threads copying the files
+        :param queue_size: (optional) number of files that can wait in the queue, the producer blocks beyond that
+        :param resume: (optional) carry on with a copy that has been interrupted: the existing folders are kept,
+        and so are the files that were completely copied
+        """
+        self.queue = queue.Queue(maxsize=queue_size or threads * 64)
+        self.resume = resume
+        self.errors = []
+        self.dirs = []
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(max(threads, 1))]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, src, dst, copy_function):
+        """Queues a single file
+        :param src: text, the source file
+        :param dst: text, the destination file
+        :param copy_function: function used to copy the file, e.g. CopyEngine.copy
+        """
+        self.queue.put((src, dst, copy_function))
+
+    def copytree(self, src, dst, copy_function, matcher=None, rel_src=''):
+        """Same as shutil.copytree(src, dst, symlinks=True), the files being copied by the threads
+        :param src: text, the source folder
+        :param dst: text, the destination folder, which must not exist
+        :param copy_function: function used to copy the files, e.g. CopyEngine.copy2
+        :param matcher: (optional) utils.ExclusionMatcher, the excluded elements are not copied
+        :param rel_src: (optional) text, the path of src relative to the folder the matcher has been built for
+        """
+        self._mkdir(dst)
+        self.dirs.append((src, dst))
+        stack = [(src, dst, rel_src)]
+        while stack:
+            src_fld, dst_fld, rel_fld = stack.pop()
+            try:
+                with os.scandir(src_fld) as entries:
+                    entries = list(entries)
+            except OSError as exc:
+                self.errors.append((src_fld, exc))
+                continue
+            for entry in entries:
+                target = join(dst_fld, entry.name)
+                rel = f'{rel_fld}/{entry.name}' if rel_fld else entry.name
+                try:
+                    if matcher and matcher.excluded(rel, entry.is_dir()):
+                        continue
+                    if entry.is_symlink():
+                        self._symlink(entry.path, target)
+                    elif entry.is_dir():
+                        self._mkdir(target)
+                        self.dirs.append((entry.path, target))
+                        stack.append((entry.path, target, rel))
+                    else:
+                        self.submit(entry.path, target, copy_function)
+                except OSError as exc:
+                    self.errors.append((entry.path, exc))
+
+    def copywalk(self, dst, entries, copy_function):
+        """Copies the elements yielded by a walk, e.g. utils.walk_hidden, the files being copied by the threads
+        :param dst: text, the destination folder, which must exist
+        :param entries: iterable of (relative path, os.DirEntry) tuples, each folder coming before its content
+        :param copy_function: function used to copy the files, e.g. CopyEngine.copy2
+        """
+        for rel, entry in entries:
+            target = join(dst, rel)
+            try:
+                if entry.is_symlink():
+                    self._symlink(entry.path, target)
+                elif entry.is_dir():
+                    self._mkdir(target)
+                    self.dirs.append((entry.path, target))
+                else:
+                    self.submit(entry.path, target, copy_function)
+            except OSError as exc:
+                self.errors.append((entry.path, exc))
+
+    def join(self):
+        """Waits for the queued files, then copies the metadata of the folders
+        :return: The list of (path, exception) tuples of the elements that couldn't be copied
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        # Done last, as copying the files changes the modification time of the folders
+        for src, dst in reversed(self.dirs):
+            try:
+                shutil.copystat(src, dst)
+            except OSError as exc:
+                self.errors.append((src, exc))
+        return self.errors
+
+    def _mkdir(self, path):
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            if not (self.resume and os.path.isdir(path)):
+                raise
+
+    def _symlink(self, src, dst):
+        if self.resume and os.path.lexists(dst):
+            os.unlink(dst)
+        os.symlink(os.readlink(src), dst)
+
+    @staticmethod
+    def _copied(src, dst):
+        """Tells whether an interrupted copy already completed a file. The modification time of the source is
+        applied once the content has been written, a file that was cut short doesn't have it
+        :return: True if the file doesn't have to be copied again
+        """
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            return False
+        src_st = os.stat(src)
+        if dst_st.st_size == src_st.st_size and dst_st.st_mtime_ns == src_st.st_mtime_ns:
+            PROFILE.count('copy', 'files_resumed')
+            LOG.advance(1, src_st.st_size)
+            return True
+        # Replaced instead of overwritten, it may be hardlinked to a previous backup
+        os.unlink(dst)
+        return False
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            src, dst, copy_function = job
+            try:
+                if not (self.resume and self._copied(src, dst)):
+                    copy_function(src, dst)
+            except Exception as exc:
+                self.errors.append((src, exc))
@@ -0,0 +1,104 @@
+"""Dependency folder cache
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import json
+import hashlib
+from os.path import join
+
+# Kept in the output folder, next to the backups
+CACHE_NAME = '.shlerp_deps'
+
+
+def lock_hash(proj_fld, dep_folder, lockfiles):
+    """Projects whose lockfiles are identical are assumed to have the same dependency folder
+    :param proj_fld: text, the project folder
+    :param dep_folder: text, the dependency folder of the rule of the project
+    :param lockfiles: list of the lockfiles of the rule, relative to the project folder
+    :return: The hash of the lockfiles found in the project, in hex, or None if the project has none of them
+    """
+    digest = hashlib.blake2b(dep_folder.encode(), digest_size=20)
+    found = False
+    for name in lockfiles:
+        try:
+            with open(join(proj_fld, name), 'rb') as read_lockfile:
+                data = read_lockfile.read()
+        except OSError:
+            continue
+        found = True
+        digest.update(f'\0{name}\0{len(data)}\0'.encode())
+        digest.update(data)
+    return digest.hexdigest() if found else None
+
+
+class DepCache:
+    """Remembers which backup of the output folder holds the dependency folder built from some lockfiles,
+    and keeps a zip archive of it whose members can be spliced into the next zip archives"""
+
+    def __init__(self, output, key):
+        """
+        :param output: text, the output folder of the backups
+        :param key: text, the hash of the lockfiles given by lock_hash()
+        """
+        self.fld = join(output, CACHE_NAME)
+        self.key = key
+
+    def folder(self):
+        """
+        :return: The path of the dependency folder of an earlier backup, or None if there is none anymore
+        """
+        try:
+            with open(join(self.fld, f'{self.key}.json'), 'r') as read_entry:
+                path = json.load(read_entry)['folder']
+        except (OSError, ValueError, KeyError):
+            return None
+        return path if os.path.isdir(path) else None
+
+    def record(self, path):
+        """Points the cache at a dependency folder that has just been copied
+        :param path: text, the dependency folder of the new backup
+        """
+        self._replace(f'{self.key}.json', lambda tmp: self._dump(tmp, {'folder': path}))
+
+    def archive(self, variant):
+        """
+        :param variant: text, what changes the members of the archive, e.g. the compression level
+        :return: The path of the cached archive of the dependency folder, or None if it hasn't been made yet
+        """
+        path = join(self.fld, f'{self.key}-{variant}.zip')
+        return path if os.path.isfile(path) else None
+
+    def keep_archive(self, archive_path, prefix, variant):
+        """Copies the members of the dependency folder out of a zip archive that has just been made
+        :param archive_path: text, the zip archive
+        :param prefix: text, the name of the dependency folder within the archive, followed by a "/"
+        :param variant: text, what changes the members of the archive, e.g. the compression level
+        :return: The number of members kept
+        """
+        import archive
+
+        def write(tmp):
+            with archive.ParallelZip(tmp, threads=1) as zip_file:
+                return len(zip_file.splice(archive_path, prefix))
+        return self._replace(f'{self.key}-{variant}.zip', write)
+
+    @staticmethod
+    def _dump(path, data):
+        with open(path, 'w') as write_entry:
+            json.dump(data, write_entry)
+
+    def _replace(self, name, write):
+        # The entries are replaced atomically, the --jobs workers may share the cache
+        os.makedirs(self.fld, exist_ok=True)
+        path = join(self.fld, name)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            result = write(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return result
@@ -0,0 +1,166 @@
+"""Gitignore matcher
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import re
+
+
+def translate(pattern):
+    """Converts a gitignore glob into a regex, "*" and "?" don't match "/" while "**" matches any number of folders
+    :param pattern: text, a pattern without its "!" prefix nor its leading and trailing "/"
+    :return: The regex, as text
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**' and (i == 0 or pattern[i - 1] == '/') and (i + 2 == n or pattern[i + 2] == '/'):
+                if i + 2 == n:
+                    # "a/**" matches everything inside a
+                    res.append('.*')
+                    i += 2
+                else:
+                    # "**/a" and "a/**/b" match zero or more folders
+                    res.append('(?:.*/)?')
+                    i += 3
+                continue
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            end, chars = bracket(pattern, i)
+            if end == -1:
+                res.append(re.escape(c))
+            else:
+                res.append(chars)
+                i = end
+        elif c == '\\' and i + 1 < n:
+            res.append(re.escape(pattern[i + 1]))
+            i += 1
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+
+def bracket(pattern, start):
+    """Converts a bracket expression, e.g. "[!a-z]". A "]" right after "[", "[!" or "[^" is a member of the set
+    :param pattern: text, the pattern
+    :param start: number, the position of the "["
+    :return: The position of the closing "]" and the regex of the set, or -1 and None if the set isn't closed
+    """
+    i = start + 1
+    negated = pattern[i:i + 1] in ('!', '^')
+    if negated:
+        i += 1
+    members = []
+    first = True
+    while i < len(pattern):
+        c = pattern[i]
+        if c == ']' and not first:
+            return i, f'[{"^" if negated else ""}{"".join(members)}]'
+        escaped = c == '\\' and i + 1 < len(pattern)
+        if escaped:
+            i += 1
+            c = pattern[i]
+        # The "-" of the ranges is kept, every other character stands for itself
+        members.append(c if c == '-' and not escaped else re.escape(c))
+        first = False
+        i += 1
+    return -1, None
+
+
+def parse(lines, on_invalid=None):
+    """
+    :param lines: the lines of a .gitignore file
+    :param on_invalid: (optional) function called with a line and the error when its pattern can't be compiled,
+    the line being skipped
+    :return: A list of (compiled regex, negated, folders only, anchored) tuples, in the order of the file
+    """
+    rules = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        # Trailing spaces are ignored unless they are escaped
+        while line.endswith(' ') and not line.endswith('\\ '):
+            line = line[:-1]
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        # A "/" anywhere but at the end anchors the pattern to the folder of the .gitignore file
+        anchored = '/' in line
+        line = line.lstrip('/')
+        if not line:
+            continue
+        try:
+            regex = re.compile(translate(line))
+        except re.error as exc:
+            if on_invalid:
+                on_invalid(line, exc)
+            continue
+        rules.append((regex, negated, dir_only, anchored))
+    return rules
+
+
+class GitIgnore:
+    """Tells whether the elements of a project are ignored by git, according to .git/info/exclude and the
+    .gitignore files of the project. The .gitignore file of a folder is read the first time one of its elements
+    is checked. The elements of an ignored folder can't be re-included, which is why the walks prune ignored
+    folders instead of checking their content"""
+
+    def __init__(self, proj_fld, on_invalid=None):
+        """
+        :param proj_fld: text, the project folder
+        :param on_invalid: (optional) function called with the path of a file, one of its lines and the error,
+        when the line can't be used
+        """
+        self.proj_fld = proj_fld
+        self.on_invalid = on_invalid
+        # relative folder path -> rules of its .gitignore file
+        self.rules = {}
+        self.exclude = self._read(f'{proj_fld}/.git/info/exclude')
+
+    def _read(self, path):
+        on_invalid = (lambda line, exc: self.on_invalid(path, line, exc)) if self.on_invalid else None
+        try:
+            with open(path, 'r', errors='surrogateescape') as read_rules:
+                return parse(read_rules, on_invalid)
+        except OSError:
+            return []
+
+    def _folder_rules(self, rel_dir):
+        rules = self.rules.get(rel_dir)
+        if rules is None:
+            rules = self.rules[rel_dir] = self._read(
+                f'{self.proj_fld}/{rel_dir}/.gitignore' if rel_dir else f'{self.proj_fld}/.gitignore'
+            )
+        return rules
+
+    def ignored(self, rel_path, is_dir=False):
+        """
+        :param rel_path: text, the path of an element, relative to the project folder
+        :param is_dir: True if the element is a folder
+        :return: True if the last pattern matching the element ignores it
+        """
+        # Git data is handled by --nogit
+        if rel_path == '.git' or rel_path.startswith('.git/'):
+            return False
+        chunks = rel_path.split('/')
+        name = chunks[-1]
+        # The deepest .gitignore files take precedence, then .git/info/exclude, the last matching line winning
+        sources = [('/'.join(chunks[:depth]), self._folder_rules('/'.join(chunks[:depth])))
+                   for depth in range(len(chunks) - 1, -1, -1)]
+        sources.append(('', self.exclude))
+        for base, rules in sources:
+            sub_path = rel_path[len(base) + 1:] if base else rel_path
+            for regex, negated, dir_only, anchored in reversed(rules):
+                if dir_only and not is_dir:
+                    continue
+                if regex.fullmatch(sub_path if anchored else name):
+                    return not negated
+        return False
@@ -0,0 +1,153 @@
+"""Git index reader
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import struct
+from collections import namedtuple
+from gitignore import GitIgnore
+
+# ctime (s, ns), mtime (s, ns), dev, ino, mode, uid, gid, size, object name, flags
+ENTRY_HEADER = struct.Struct('>10I20sH')
+EXTENDED_FLAG = 0x4000
+NAME_MASK = 0xFFF
+GITLINK_MODE = 0o160000
+
+IndexEntry = namedtuple('IndexEntry', 'mtime_ns size ino mode sha1')
+
+
+def read_varint(data, pos):
+    """Reads the offset encoding used by the version 4 of the index to prefix-compress the paths
+    :return: The value, and the position that follows it
+    """
+    byte = data[pos]
+    pos += 1
+    value = byte & 0x7F
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (byte & 0x7F)
+    return value, pos
+
+
+def parse(data):
+    """Parses the entries of a git index, versions 2 to 4. The extensions that follow them are ignored
+    :param data: bytes, the content of .git/index
+    :return: A dictionary mapping the paths of the entries to IndexEntry tuples
+    """
+    if data[:4] != b'DIRC':
+        raise ValueError('not a git index')
+    version, count = struct.unpack_from('>II', data, 4)
+    if version not in (2, 3, 4):
+        raise ValueError(f'unsupported git index version {version}')
+    entries = {}
+    pos = 12
+    name = b''
+    for _ in range(count):
+        start = pos
+        fields = ENTRY_HEADER.unpack_from(data, pos)
+        pos += ENTRY_HEADER.size
+        flags = fields[11]
+        if version >= 3 and flags & EXTENDED_FLAG:
+            pos += 2
+        if version == 4:
+            strip, pos = read_varint(data, pos)
+            end = data.index(b'\0', pos)
+            name = name[:len(name) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            length = flags & NAME_MASK
+            end = pos + length if length < NAME_MASK else data.index(b'\0', pos)
+            name = data[pos:end]
+            # Entries are padded with 1 to 8 NUL bytes, up to a multiple of 8 bytes
+            pos = start + ((end - start) // 8 + 1) * 8
+        # Only the first stage of a conflicting path is kept, they all point to the same file on disk
+        path = name.decode('utf-8', 'surrogateescape')
+        if path not in entries:
+            entries[path] = IndexEntry(
+                fields[2] * 10 ** 9 + fields[3], fields[9], fields[5], fields[6], fields[10].hex()
+            )
+    return entries
+
+
+class Index:
+    """The files git tracks in a project, read from .git/index without calling git"""
+
+    def __init__(self, proj_fld, on_invalid=None):
+        """
+        :param proj_fld: text, the project folder, which must be the root of a git repository
+        :param on_invalid: (optional) function called for the .gitignore lines that can't be used, see GitIgnore
+        :raise OSError: if the index can't be read
+        :raise ValueError: if the index can't be parsed
+        """
+        self.proj_fld = proj_fld
+        self.on_invalid = on_invalid
+        path = f'{proj_fld}/.git/index'
+        with open(path, 'rb') as read_index:
+            self.entries = parse(read_index.read())
+        # The files modified within the same second as the index may have changed after it was written
+        self.written_ns = os.stat(path).st_mtime_ns
+        # Every folder containing tracked files, the root of the project included
+        self.dirs = {''}
+        for path, entry in self.entries.items():
+            if entry.mode == GITLINK_MODE:
+                self.dirs.add(path)
+            parent = path.rpartition('/')[0]
+            while parent not in self.dirs:
+                self.dirs.add(parent)
+                parent = parent.rpartition('/')[0]
+
+    def tracked(self, rel_path):
+        return rel_path in self.entries or rel_path in self.dirs
+
+    def clean_hash(self, rel_path, st):
+        """Gives the git object name of a file without reading it, when its stat data matches the index
+        :param rel_path: text, the path of the file, relative to the project folder
+        :param st: os.stat_result of the file
+        :return: The object name prefixed with "git:", or None if the file may have changed since it was staged
+        """
+        entry = self.entries.get(rel_path)
+        if not entry or entry.mode == GITLINK_MODE:
+            return None
+        if entry.size != st.st_size or entry.mtime_ns != st.st_mtime_ns or entry.ino != st.st_ino:
+            return None
+        # "Racily clean" entries: the file may have been modified right after being staged
+        if st.st_mtime_ns // 10 ** 9 >= self.written_ns // 10 ** 9:
+            return None
+        return f'git:{entry.sha1}'
+
+    def walk(self, prune=None, onerror=None):
+        """Same as utils.walk_hidden, the elements being sorted out with the index: the tracked ones don't go
+        through the .gitignore files, the untracked ones are only kept when git doesn't ignore them, and an ignored
+        folder isn't listed at all
+        :param prune: (optional) function called with (relative path, is_dir), returning True to skip an element
+        :param onerror: (optional) function called with the OSError raised when a folder can't be listed
+        :return: A generator of (relative path, os.DirEntry) tuples, each folder coming before its content
+        """
+        ignore = GitIgnore(self.proj_fld, self.on_invalid)
+        # A folder ignored by git but containing tracked files is walked, only its tracked elements being kept
+        stack = [('', False)]
+        while stack:
+            rel_fld, ignored_fld = stack.pop()
+            try:
+                entries = os.scandir(f'{self.proj_fld}/{rel_fld}' if rel_fld else self.proj_fld)
+            except OSError as exc:
+                if not onerror:
+                    raise
+                onerror(exc)
+                continue
+            # Nothing below an untracked folder is tracked, the index isn't looked up there
+            tracked_fld = rel_fld in self.dirs
+            with entries:
+                for entry in entries:
+                    rel_name = f'{rel_fld}/{entry.name}' if rel_fld else entry.name
+                    is_dir = entry.is_dir()
+                    ignored = ignored_fld or ignore.ignored(rel_name, is_dir)
+                    if ignored and not (tracked_fld and self.tracked(rel_name)):
+                        continue
+                    if prune and prune(rel_name, is_dir):
+                        continue
+                    yield rel_name, entry
+                    if is_dir and not entry.is_symlink():
+                        stack.append((rel_name, ignored))
@@ -0,0 +1,75 @@
+"""Batch journal
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import json
+from profiler import PROFILE
+
+# Kept in the folder receiving the backups of the batch
+JOURNAL_NAME = '.shlerp_journal'
+
+
+class Journal:
+    """Records the progress of a batch run, so that an interrupted run can be resumed.
+    Each line is a json object: the first one describes the run, the others the state of a project
+    (pending, running, done or failed), the last line of a project winning when the journal is read back.
+    Lines are appended with a single write, so that the --jobs workers can record their projects themselves"""
+
+    def __init__(self, path):
+        """
+        :param path: text, the location of the journal
+        """
+        self.path = path
+
+    def read(self):
+        """
+        :return: The description of the run, and a dictionary mapping each project folder to its last state,
+        both empty if there is no journal
+        """
+        run, projects = {}, {}
+        try:
+            with open(self.path, 'r') as read_journal:
+                lines = read_journal.readlines()
+        except OSError:
+            return run, projects
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short by the interruption
+                continue
+            if 'project' in record:
+                projects.setdefault(record['project'], {}).update(record)
+            else:
+                run = record
+        return run, projects
+
+    def start(self, run, projects):
+        """Replaces the journal with the one of a new run
+        :param run: dictionary describing the run, e.g. its source folder and its operation
+        :param projects: list of dictionaries describing the state of each project
+        """
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as write_journal:
+            for record in [run] + projects:
+                write_journal.write(json.dumps(record) + '\n')
+            write_journal.flush()
+            with PROFILE.stage('fsync'):
+                os.fsync(write_journal.fileno())
+        os.replace(tmp_path, self.path)
+
+    def write(self, proj_fld, **fields):
+        """Records a new state of a project
+        :param proj_fld: text, the project folder
+        :param fields: the fields of the state, e.g. state='done'
+        """
+        record = json.dumps({'project': proj_fld, **fields}) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, record.encode())
+            with PROFILE.stage('fsync'):
+                os.fsync(fd)
+        finally:
+            os.close(fd)
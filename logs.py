@@ -0,0 +1,204 @@
+"""Run output
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import click
+
+MODES = ('normal', 'quiet', 'progress')
+# The lines printed on the terminal and the records of the log file are written in batches, at most this often
+FLUSH_INTERVAL = 0.1
+FLUSH_RECORDS = 1024
+# The progress line is redrawn at most this often
+PROGRESS_INTERVAL = 0.25
+
+_stamp = [None, '']
+
+
+def timestamp():
+    """The timestamp only changes once per second, so it is formatted once per second
+    :return: The current time, e.g. 171026073518
+    """
+    now = int(time.time())
+    if now != _stamp[0]:
+        _stamp[:] = [now, time.strftime('%d%m%y%H%M%S', time.localtime(now))]
+    return _stamp[1]
+
+
+def human_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}TB'
+
+
+class Output:
+    """Everything the run prints goes through here.
+    In the normal mode, the informative lines are written in batches instead of one terminal write per line.
+    The quiet mode only prints the warnings and errors, the progress mode adds a single line that is redrawn
+    with the number of files and bytes processed so far. Whatever the mode, every message can also be recorded
+    as a json line in a log file"""
+
+    def __init__(self):
+        self.mode = 'normal'
+        self.log_path = None
+        # The process drawing the progress line, the worker processes of --jobs only count
+        self.owner = None
+        self.lines = []
+        self.records = []
+        self.last_flush = self.last_render = 0
+        self.files = self.bytes = 0
+        self.projects_done = self.projects_total = 0
+        self.started = time.time()
+        self.drawn = False
+        # Files are counted by the threads of a CopyPipeline
+        self.lock = threading.RLock()
+
+    def configure(self, mode, log_path=None, projects_total=0):
+        """
+        :param mode: text, one of MODES
+        :param log_path: (optional) text, the json lines file that receives every message
+        :param projects_total: (optional) number of projects of the run, used for the estimated time left
+        """
+        self.mode = mode
+        self.log_path = log_path
+        self.owner = os.getpid()
+        self.projects_total = projects_total
+        self.started = time.time()
+
+    def shows(self, lvl):
+        """
+        :param lvl: letter of the level of a message, I, W or E
+        :return: True if a message of this level has to be formatted at all
+        """
+        return self.mode == 'normal' or lvl != 'I' or bool(self.log_path)
+
+    def message(self, string, lvl, color=None, record=None):
+        """Prints a message according to the mode, and records it in the log file
+        :param string: text, the formatted message
+        :param lvl: letter of the level of the message, I, W or E
+        :param color: (optional) text, the color of the message on the terminal
+        :param record: (optional) dictionary, the fields of the message for the log file
+        """
+        with self.lock:
+            if record is not None and self.log_path:
+                self.records.append(json.dumps(record, ensure_ascii=False) + '\n')
+            if lvl == 'I' and self.mode != 'normal':
+                self.flush(force=False)
+                return
+            if lvl == 'I':
+                self.lines.append(string + '\n')
+                self.flush(force=False)
+                return
+            # Warnings and errors are printed right away, after whatever is waiting
+            self.flush()
+            self._clear_progress()
+            click.echo(click.style(string, fg=color))
+
+    def advance(self, files=1, size=0):
+        """Counts processed files for the progress line
+        :param files: (optional) number of files processed
+        :param size: (optional) number of bytes processed
+        """
+        with self.lock:
+            self.files += files
+            self.bytes += size
+            self._render()
+            self.flush(force=False)
+
+    def project_done(self, done, failed):
+        """
+        :param done: number of projects that have been processed successfully so far
+        :param failed: number of projects that failed so far
+        """
+        with self.lock:
+            self.projects_done = done + failed
+            self._render()
+
+    def collect(self):
+        """
+        :return: The files and bytes counted so far, which are then cleared
+        """
+        with self.lock:
+            counts, self.files, self.bytes = (self.files, self.bytes), 0, 0
+        return counts
+
+    def merge(self, counts):
+        """Adds the files and bytes counted by another process, e.g. a --jobs worker
+        :param counts: the tuple returned by collect()
+        """
+        self.advance(*counts)
+
+    def flush(self, force=True):
+        """Writes the lines and records waiting to be printed
+        :param force: (optional) write them even if the last write is recent
+        """
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_flush < FLUSH_INTERVAL and \
+                    len(self.lines) + len(self.records) < FLUSH_RECORDS:
+                return
+            self.last_flush = now
+            if self.lines:
+                lines, self.lines = ''.join(self.lines), []
+                sys.stdout.write(lines)
+                sys.stdout.flush()
+            if self.records:
+                records, self.records = ''.join(self.records).encode(), []
+                # A single write in append mode, so that the records of the --jobs workers don't interleave
+                try:
+                    fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    try:
+                        os.write(fd, records)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+
+    def finish(self):
+        """Writes what is left, and ends the progress line"""
+        with self.lock:
+            self.flush()
+            if self.mode == 'progress' and self.owner == os.getpid() and (self.drawn or self.files):
+                self._render(force=True)
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+                self.drawn = False
+                # Drawn once, even if finish() is called again at exit
+                self.files = self.bytes = 0
+
+    def _clear_progress(self):
+        if self.drawn:
+            sys.stdout.write('\r\033[K')
+            self.drawn = False
+
+    def _render(self, force=False):
+        if self.mode != 'progress' or self.owner != os.getpid():
+            return
+        now = time.time()
+        if not force and now - self.last_render < PROGRESS_INTERVAL:
+            return
+        self.last_render = now
+        elapsed = max(now - self.started, 1e-6)
+        line = f'{self.files} files - {human_size(self.bytes)} - {human_size(self.bytes / elapsed)}/s'
+        if self.projects_total > 1:
+            line += f' - {self.projects_done}/{self.projects_total} projects'
+            if 0 < self.projects_done < self.projects_total:
+                left = elapsed / self.projects_done * (self.projects_total - self.projects_done)
+                line += f' - ETA {int(left // 60)}m{int(left % 60):02d}s'
+        line += f' - {int(elapsed // 60)}m{int(elapsed % 60):02d}s'
+        sys.stdout.write(f'\r\033[K{line}')
+        sys.stdout.flush()
+        self.drawn = True
+
+
+# Shared by the whole process, configured with --quiet, --progress and --log-file
+LOG = Output()
+atexit.register(LOG.finish)
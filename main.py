@@ -4,124 +4,52 @@ All Rights Reserved.
 Released under the GNU Affero General Public License v3.0
 """
 import utils
+import ruleset as rules_index
+from state import StateStore
+from profiler import PROFILE
+from logs import LOG
 import os
-import shutil
+import stat
 from os.path import exists
-from zipfile import ZipFile, ZIP_DEFLATED, ZipInfo
 import time
+import itertools
 import click
 from click import echo
 from utils import s_print
 import json
 
-summ = {
-    'total': 0,
-    'done': 0,
-    'failed': 0,
-    'failures': [],
-    'ad_failures': []
-}
+# The modules of the archive, copy and store code paths are imported by the functions using them, so that a run
+# only pays for what it does. Keep in sync with archive.FORMATS, which isn't imported at startup
+ARCHIVE_FORMATS = ('zip', 'tar.gz', 'tar.xz', 'tar.zst')
 
 
-def auto_detect(proj_fld, settings, uid):
+def auto_detect(proj_fld, ruleset, settings, state, uid):
     leads = []
     tried_history = False
     tried_all = False
+    rules_history = state.history(settings['rules']['history_limit'])
+    if not rules_history:
+        s_print('scan', 'I', 'No detection history yet, will use the whole ruleset instead', uid)
+        tried_history = True
     while True:
-        # Try...Except
-        try:
-            with open(f'{os.getcwd()}/rules.json', 'r') as read_file:
-                rules = json.load(read_file)
-        except FileNotFoundError:
-            s_print('scan', 'E', 'rules.json not found', uid)
-            exit(1)
-        # If the rules history hasn't been checked yet, only keep the rules that are mentioned in the tmp file
+        # If the rules history hasn't been checked yet, only keep the rules that were elected the most often
         if not tried_history:
-            try:
-                with open(f'{os.getcwd()}/tmp.json', 'r') as read_tmp:
-                    tmp_file = json.load(read_tmp)
-                    rules_history = tmp_file['rules_history']
-                    for rule in rules:
-                        if rule['name'] not in rules_history:
-                            current_pos = rules.index(rule)
-                            rules.pop(current_pos)
-            except (FileNotFoundError, ValueError):
-                s_print('scan', 'I', 'Temp file not found, will use the whole ruleset instead', uid)
-                tmp_file = {'rules_history': []}
-                with open(f'{os.getcwd()}/tmp.json', 'w') as write_tmp:
-                    write_tmp.write(json.dumps(tmp_file, indent=4))
-                tried_history = True
+            names = [name for name in ruleset.names if name in rules_history]
         else:
-            to_prune = []
-            for rule_name in rules_history:
-                for rule in rules:
-                    if rule['name'] == rule_name:
-                        to_prune.append(rule)
-            for junk in to_prune:
-                rules.remove(junk)
-
-        for rule in rules:
-            extensions = []
-            total = 0
-            for file in rule['detect']['files']:
-                names = file['name']
-                pattern = file['pattern']
-                if len(names) == 1:
-                    # If only one extension, add it to the extension array
-                    if names[0].startswith('*.'):
-                        extensions.append({
-                            'name': names[0],
-                            'weight': file['weight']
-                        })
-                    else:
-                        # If only one filename check if it exists, then check its content
-                        filename = names[0]
-                        if exists(f'{proj_fld}/{filename}'):
-                            # If the pattern defined in the rule is not set to null, search it in the file
-                            if pattern:
-                                with open(f'{proj_fld}/{filename}', 'r') as file_content:
-                                    if pattern in file_content:
-                                        total += file['weight']
-                            else:
-                                total += file['weight']
-                if len(names) > 1:
-                    for name in names:
-                        if name.startswith('*.'):
-                            extensions.append({
-                                'name': name,
-                                'weight': file['weight']
-                            })
-                        else:
-                            # If the filename is not an extension, check for its existence right away
-                            if exists(f'{proj_fld}/{name}'):
-                                total += file['weight']
-
-            for folder in rule['detect']['folders']:
-                name = folder['name']
-                # We check if each folder from the current rule exists
-                if exists(f'{proj_fld}/{name}/'):
-                    # If we don't have any files to check in the folder, increment the rule weight
-                    if not folder['files']:
-                        total += folder['weight']
-                    else:
-                        # Make sure that each files from the folder element exists before increasing the weight
-                        match = True
-                        for file in folder['files']:
-                            if not exists(f'{proj_fld}/{folder["name"]}/{file}'):
-                                match = False
-                        if match:
-                            total += folder['weight']
-            rule["total"] = total
-            rule["extensions"] = extensions
-            leads.append(rule)
+            names = [name for name in ruleset.names if name not in rules_history]
+
+        # Only the root of the project is listed, then intersected with the files and folders of the ruleset
+        with PROFILE.stage('detect_stat'):
+            leads = ruleset.score(proj_fld, names)
 
         crawled = False
         if utils.weight_found(leads):
             leads = utils.elect(leads)
         else:
             # If the main method we use to find weight (filename matching) hasn't matched anything
-            # Use iglob to match files that have a given extension and update the weights
-            leads = utils.crawl_for_weight(proj_fld, leads)
+            # Crawl the project to match files that have a given extension and update the weights
+            with PROFILE.stage('detect_crawl'):
+                leads = utils.crawl_for_weight(proj_fld, leads, ruleset.dep_folders)
             crawled = True
             if utils.weight_found(leads):
                 leads = utils.elect(leads)
@@ -130,7 +58,8 @@ def auto_detect(proj_fld, settings, uid):
         if utils.weight_found(leads) and len(leads) > 1:
             if not crawled:
                 s_print('scan', 'I', 'Crawling...', uid)
-                leads = utils.crawl_for_weight(proj_fld, leads)
+                with PROFILE.stage('detect_crawl'):
+                    leads = utils.crawl_for_weight(proj_fld, leads, ruleset.dep_folders)
 
         if not tried_history:
             tried_history = True
@@ -150,12 +79,10 @@ def auto_detect(proj_fld, settings, uid):
         else:
             if utils.weight_found(leads):
                 # Successful exit point
-                # Check if the history in the tmp file can be updated before breaking out of the loop
-                if not utils.history_updated(leads[0], settings, tmp_file):
-                    s_print('scan', 'I', 'A problem occurred when trying to write in tmp.json', uid)
-                    break
-                else:
-                    break
+                # Count this election in the history before breaking out of the loop
+                if not state.record_hit(leads[0]['name']):
+                    s_print('scan', 'I', f'A problem occurred when trying to write in {state.path}', uid)
+                break
             else:
                 leads = list([])
                 if tried_all:
@@ -164,6 +91,76 @@ def auto_detect(proj_fld, settings, uid):
     return leads[0] if leads else False
 
 
+def gitignore_warning(operation, uid, count):
+    """
+    :return: A function printing the .gitignore lines that are skipped because they can't be used
+    """
+    def warn(path, line, exc):
+        s_print(operation, 'W', f'Skipped the line "{line}" of {path}: {exc}', uid, cnt=count)
+    return warn
+
+
+def exclusion_matcher(proj_fld, exclusions, options, exclude_dep=True, on_invalid=None, hidden='all'):
+    """Builds the matcher of a project, its decisions being measured when profiling
+    :param proj_fld: text, the project folder
+    :param exclusions: Dictionary containing the files and folders we want to exclude
+    :param options: dictionary/object containing exclusion options
+    :param exclude_dep: (optional) also exclude the dependency folder of the rule
+    :param on_invalid: (optional) function called for the .gitignore lines that can't be used, see gitignore_warning
+    :param hidden: (optional) which hidden elements are excluded, see utils.ExclusionMatcher
+    :return: An utils.ExclusionMatcher object
+    """
+    ignored = None
+    if options['respect_gitignore']:
+        import gitignore
+        ignored = gitignore.GitIgnore(proj_fld, on_invalid)
+    matcher = utils.ExclusionMatcher(exclusions, options, exclude_dep, ignored, hidden)
+    matcher.excluded = PROFILE.wrap('filter', matcher.excluded)
+    return matcher
+
+
+def read_git_index(proj_fld, options, operation, uid, count):
+    """
+    :param proj_fld: text, the project folder
+    :param options: dictionary/object containing exclusion options
+    :param operation: text, the operation shown in the messages
+    :return: The gitindex.Index of the project with --git-index, None without it or if there is no index
+    """
+    if not options['git_index'] or not exists(f'{proj_fld}/.git/index'):
+        return None
+    import gitindex
+    try:
+        return gitindex.Index(proj_fld, gitignore_warning(operation, uid, count))
+    except (OSError, ValueError) as exc:
+        s_print(operation, 'W', f'Unable to read the git index, the whole project is walked instead: {exc}', uid,
+                cnt=count)
+        return None
+
+
+def dep_cache(proj_fld, rule, options):
+    """
+    :param proj_fld: text, the project folder
+    :param rule: dictionary/object representing the rule/language corresponding to the project
+    :param options: dictionary/object containing exclusion options
+    :return: The depcache.DepCache of the dependency folder of the project, None if it can't be cached
+    """
+    exclusions = rule['actions']['exclude']
+    dep_folder = exclusions['dep_folder']
+    # Without --output, the backups are next to the projects and the cache would end up among them
+    if options['no_cache'] or not options['output'] or not dep_folder or \
+            not os.path.isdir(f'{proj_fld}/{dep_folder}'):
+        return None
+    import depcache
+    key = depcache.lock_hash(proj_fld, dep_folder, exclusions.get('lockfiles', []))
+    return depcache.DepCache(options['output'], key) if key else None
+
+
+def count_skipped(matcher):
+    """Reports the elements left out by a matcher, by kind of exclusion"""
+    for reason, amount in matcher.skipped.items():
+        PROFILE.count('filter', f'skipped_{reason}', amount)
+
+
 def make_archive(proj_fld, dst_path, rule, options, uid, started, count):
     """Makes an archive of a given folder, without node_modules
     :param proj_fld: text, the folder we want to archive
@@ -173,113 +170,110 @@ def make_archive(proj_fld, dst_path, rule, options, uid, started, count):
     :param uid: text representing a short uid
     :param started: number representing the time when the script has been executed
     """
-    with ZipFile(f'{dst_path}.zip', 'w', ZIP_DEFLATED, compresslevel=9) as zip_archive:
-        fld_count = file_count = symlink_count = 0
-        success = False
-        if summ['total'] == 1:
-            count = ''
-        for elem_name in utils.iglob_hidden(proj_fld + '/**', recursive=True):
-            rel_name = elem_name.split(f'{proj_fld}/')[1]
-            proceed = True
-            output = True
-            exclusions = rule['actions']['exclude']
-            dep_folder = exclusions['dep_folder']
-            if options['nogit']:
-                exclusions['folders'].append('.git')
-                exclusions['files'].append('.gitignore')
-
-            #####################
-            # Exclusion zone
-
-            # Reject the current relative path if one of these conditions are matched
-            if options['noexcl']:
-                proceed = True
-            else:
-                if os.path.isdir(elem_name):
-                    if dep_folder and dep_folder in rel_name:
-                        proceed = False
-                    if exclusions['folders']:
-                        for fld_excl in exclusions['folders']:
-                            if fld_excl in rel_name:
-                                proceed = False
-                else:
-                    if exclusions['files']:
-                        for file_excl in exclusions['files']:
-                            if (
-                                    file_excl == rel_name.split('/')[-1] or
-                                    (dep_folder and dep_folder in rel_name)
-                            ):
-                                proceed = False
-                    if exclusions['folders']:
-                        for fld_excl in exclusions['folders']:
-                            if fld_excl in rel_name:
-                                proceed = False
-
-            # Excludes all hidden files from the backup except git data
-            path_chunks = elem_name.split('/')
-            for chunk in path_chunks:
-                if chunk.startswith('.'):
-                    if not path_chunks[-1].startswith('.'):
-                        output = False
-                    if (
-                            not options['keephidden'] and
-                            not (
-                                    chunk == '.git' or
-                                    chunk == '.gitignore'
-                            )
-                    ):
-                        proceed = False
-
-            #####################
-            # Archive making
-
-            if proceed:
-                if rel_name == '':
-                    output = False
-                # If the elem_name is actually a symbolic link, use zip_info and zipfile.writestr()
-                # Source: https://gist.github.com/kgn/610907
-                if os.path.islink(elem_name):
+    import archive as archiver
+    fld_count = file_count = symlink_count = spliced = 0
+    success = False
+    rel_name = ''
+    archive_path = f'{dst_path}.{options["format"]}'
+    # The archive is written under a temporary name, it only gets its final name once it is complete
+    part_path = f'{archive_path}.part'
+    # Unlike duplicate(), the dependency folder is only left out of archives when the exclusions are enabled
+    matcher = exclusion_matcher(proj_fld, rule['actions']['exclude'], options, exclude_dep=not options['noexcl'],
+                                on_invalid=gitignore_warning('arch', uid, count))
+    index = read_git_index(proj_fld, options, 'arch', uid, count)
+    dep_folder = rule['actions']['exclude']['dep_folder']
+    cache = dep_cache(proj_fld, rule, options) if options['noexcl'] and options['format'] == 'zip' else None
+    # The members of the cached archive depend on the compression level and on what is excluded within the folder
+    variant = ''.join([str(options['compress_level'])] + [flag for flag, enabled in (
+        ('g', options['nogit']), ('h', options['keephidden']),
+        ('i', options['respect_gitignore'] or options['git_index'])
+    ) if enabled])
+    cached_archive = cache.archive(variant) if cache else None
+    prune = matcher.excluded
+    if cached_archive:
+        # The dependency folder is spliced from the cache, it isn't walked
+        def prune(rel_path, is_dir):
+            return rel_path == dep_folder or matcher.excluded(rel_path, is_dir)
+    walk = index.walk(prune) if index else utils.walk_hidden(proj_fld, prune)
+    previous = archiver.find_previous(archive_path) if options['incremental'] and options['format'] == 'zip' else None
+    try:
+        # Zip members are compressed on a pool of threads, tar archives are compressed as a single stream
+        with PROFILE.stage('compress'), \
+                archiver.open_archive(part_path, options['format'], options['compress_level']) as archive_file:
+            # The members of the files that didn't change are copied from the previous archive instead of compressed
+            if previous:
+                try:
+                    archive_file.reuse(previous)
+                    s_print('arch', 'I', f'Incremental archive from {previous}', uid, cnt=count)
+                except (OSError, ValueError) as exc:
+                    s_print('arch', 'W', f'Unable to read {previous}, every file is compressed: {exc}', uid, cnt=count)
+            # Excluded and hidden folders are pruned by the walk, their content is never listed
+            for rel_name, entry in PROFILE.iterate('walk', walk):
+                # The content of hidden folders is archived silently
+                path_chunks = rel_name.split('/')
+                output = path_chunks[-1].startswith('.') or not any(chunk.startswith('.') for chunk in path_chunks)
+
+                #####################
+                # Archive making
+
+                if entry.is_symlink():
                     symlink_count += 1
-                    # http://www.mail-archive.com/python-list@python.org/msg34223.html
-                    zip_info = ZipInfo(elem_name)
-                    zip_info.create_system = 3
-                    # long type of hex val of '0xA1ED0000L',
-                    # say, symlink attr magic...
-                    zip_info.external_attr = 2716663808
-                    try:
-                        zip_archive.writestr(zip_info, os.readlink(f'{elem_name}'))
-                        if output:
-                            s_print('arch', 'I', f'Done: {rel_name}', uid, cnt=count)
-                        success = True
-                    except Exception as exc:
-                        s_print('arch', 'E', f'A problem happened while handling {rel_name}: {exc}', uid, cnt=count)
-                        summ['failures'].append(proj_fld)
-                        return utils.update_summ(summ, 1)
+                elif entry.is_dir():
+                    fld_count += 1
                 else:
-                    try:
-                        zip_archive.write(f'{elem_name}', arcname=f'{rel_name}')
-                        if os.path.isdir(elem_name):
-                            fld_count += 1
-                        else:
-                            file_count += 1
-                        if output:
-                            s_print('arch', 'I', f'Done: {rel_name}', uid, cnt=count)
-                        success = True
-                    except Exception as exc:
-                        s_print('arch', 'E', f'A problem happened while handling {rel_name}: {exc}', uid, cnt=count)
-                        summ['failures'].append(proj_fld)
-                        return utils.update_summ(summ, 1)
-        if success:
-            s_print('arch', 'I', f'Folders: {fld_count} - Files: {file_count} - Symbolic links: {symlink_count}', uid, cnt=count)
-            s_print('arch', 'I', f'✅ Project archived ({"%.2f" % (time.time() - started)}s): {dst_path}.zip', uid, cnt=count)
-            return utils.update_summ(summ, 0)
-        else:
-            s_print('arch', 'W', f'Incomplete archive: {dst_path}.zip', uid, cnt=count)
-            summ['failures'].append(proj_fld)
-            return utils.update_summ(summ, 1)
+                    file_count += 1
+                # The message is printed once the member has actually been written into the archive
+                on_done = None
+                if output:
+                    def on_done(name=rel_name):
+                        s_print('arch', 'I', f'Done: {name}', uid, cnt=count)
+                st = entry.stat(follow_symlinks=False)
+                PROFILE.count('walk', 'stat_calls')
+                if entry.is_file(follow_symlinks=False):
+                    PROFILE.count('compress', 'bytes_read', st.st_size)
+                    LOG.advance(1, st.st_size)
+                archive_file.write(entry.path, rel_name, on_done=on_done, st=st)
+                success = True
+            if cached_archive:
+                rel_name = dep_folder
+                for info in archive_file.splice(cached_archive):
+                    if info.is_dir():
+                        fld_count += 1
+                    elif stat.S_ISLNK(info.external_attr >> 16):
+                        symlink_count += 1
+                    else:
+                        file_count += 1
+                        spliced += 1
+                    LOG.advance(1, info.file_size)
+                s_print('arch', 'I', f'Done: {dep_folder}, from the dependency cache', uid, cnt=count)
+                success = True
+    except Exception as exc:
+        rel_name = getattr(exc, 'arcname', rel_name)
+        s_print('arch', 'E', f'A problem happened while handling {rel_name}: {exc}', uid, cnt=count)
+        if exists(part_path):
+            os.remove(part_path)
+        return utils.job_summ(proj_fld, 1)
+    os.replace(part_path, archive_path)
+    count_skipped(matcher)
+    PROFILE.count('compress', 'bytes_written', os.path.getsize(archive_path))
+    if cache and not cached_archive:
+        try:
+            cache.keep_archive(archive_path, f'{dep_folder}/', variant)
+        except Exception as exc:
+            s_print('arch', 'W', f'Unable to keep {dep_folder} in the dependency cache: {exc}', uid, cnt=count)
+    if success:
+        s_print('arch', 'I', f'Folders: {fld_count} - Files: {file_count} - Symbolic links: {symlink_count}', uid, cnt=count)
+        if previous:
+            s_print('arch', 'I', f'Reused: {archive_file.reused} - Compressed: {file_count - spliced - archive_file.reused}',
+                    uid, cnt=count)
+        s_print('arch', 'I', f'✅ Project archived ({"%.2f" % (time.time() - started)}s): {archive_path}', uid, cnt=count)
+        return utils.job_summ(proj_fld, 0)
+    else:
+        s_print('arch', 'W', f'Incomplete archive: {archive_path}', uid, cnt=count)
+        return utils.job_summ(proj_fld, 1)
 
 
-def duplicate(proj_fld, dst, rule, options, uid, started, count):
+def duplicate(proj_fld, dst, rule, options, uid, started, count, resume=False):
     """Duplicates a project folder, processes all files and folders. node_modules will be processed last if cache = True
     :param proj_fld: string that represents the project folder we want to duplicate
     :param dst: string that represents the destination folder where we will copy the project files
@@ -287,47 +281,242 @@ def duplicate(proj_fld, dst, rule, options, uid, started, count):
     :param options: dictionary/object containing exclusion options
     :param uid: text representing a short uid,
     :param started: number representing the time when the script has been executed
+    :param resume: (optional) True to carry on with the copy of an interrupted run, what it completed is kept
     """
+    import copier
+    import snapshot
     try:
         fld_count = file_count = symlink_count = 0
         exclusions = rule['actions']['exclude']
-        elem_list = utils.get_files(proj_fld, exclusions, options)
-        if summ['total'] == 1:
-            count = ''
-        os.mkdir(dst)
-        for elem in elem_list:
-            orig = f'{proj_fld}/{elem}'
-            full_dst = f'{dst}/{elem}'
-            if os.path.isdir(orig):
-                shutil.copytree(orig, full_dst, symlinks=True)
-                if exists(full_dst):
-                    s_print('copy', 'I', f'Done: {proj_fld}/{elem}', uid, cnt=count)
-                    fld_count += 1
-            else:
-                shutil.copy(orig, full_dst)
-                if os.path.islink(elem):
-                    symlink_count += 1
+        # Copies leave out the top-level hidden elements only, and none of them with --noexcl
+        matcher = exclusion_matcher(proj_fld, exclusions, options, on_invalid=gitignore_warning('copy', uid, count),
+                                    hidden=None if options['noexcl'] else 'top')
+        elem_list = utils.get_files(proj_fld, matcher)
+        index = read_git_index(proj_fld, options, 'copy', uid, count)
+        # The copy is made under a temporary name, it only gets its final name once it is complete
+        part = f'{dst}.part'
+        if not (resume and os.path.isdir(part)):
+            os.mkdir(part)
+        # The copy engine clones the files whenever the filesystem allows it
+        engine = copier.CopyEngine()
+        incremental = None
+        copy_file = engine.copy
+        copy_tree_file = engine.copy2
+        # In incremental mode, the files that didn't change since the previous snapshot are hardlinked
+        if options['incremental']:
+            previous = snapshot.find_previous(dst)
+            # The files whose stat data matches the git index aren't read to be hashed
+            incremental = snapshot.Snapshot(proj_fld, part, previous, options['checksum'], engine.copy,
+                                            index.clean_hash if index else None)
+            copy_file = copy_tree_file = incremental.copy
+            if incremental.previous:
+                s_print('copy', 'I', f'Incremental backup from {incremental.previous}', uid, cnt=count)
+
+        # This thread walks the project and creates the folders, the files are copied by the pipeline's threads
+        pipeline = copier.CopyPipeline(options['io_threads'], resume=resume)
+        try:
+            with PROFILE.stage('walk'):
+                if index:
+                    # The elements are listed by the git index walk, instead of one walk per top-level element
+                    walk = index.walk(matcher.excluded,
+                                      onerror=lambda exc: pipeline.errors.append((exc.filename, exc)))
+                    pipeline.copywalk(part, walk, copy_tree_file)
                 else:
-                    file_count += 1
-                if exists(full_dst):
-                    s_print('copy', 'I', f'Done: {proj_fld}/{elem}', uid, cnt=count)
+                    for elem in elem_list:
+                        orig = f'{proj_fld}/{elem}'
+                        full_dst = f'{part}/{elem}'
+                        if os.path.isdir(orig):
+                            pipeline.copytree(orig, full_dst, copy_tree_file, matcher, elem)
+                            fld_count += 1
+                        else:
+                            pipeline.submit(orig, full_dst, copy_file)
+                            if os.path.islink(orig):
+                                symlink_count += 1
+                            else:
+                                file_count += 1
+        finally:
+            # The files that are still queued once the walk is over are waited for here, even if the walk failed
+            with PROFILE.stage('copy'):
+                errors = pipeline.join()
+        count_skipped(matcher)
+        failed = {path for path, _ in errors}
+        for elem in elem_list:
+            if f'{proj_fld}/{elem}' not in failed and exists(f'{part}/{elem}'):
+                s_print('copy', 'I', f'Done: {proj_fld}/{elem}', uid, cnt=count)
 
-        s_print('copy', 'I', f'✅ Project duplicated ({"%.2f" % (time.time() - started)}s): {dst}/', uid, cnt=count)
         dep_folder = exclusions["dep_folder"]
+        cache = None
         if options['dependencies'] and exists(f'{proj_fld}/{dep_folder}'):
-            # TODO: optimize the logic here
-            # Try...Except
             start_dep_folder = time.time()
             s_print('copy', 'I', f'Processing {dep_folder}...', uid, cnt=count)
-            shutil.copytree(f'{proj_fld}/{dep_folder}', f'{dst}/{dep_folder}', symlinks=True)
+            # The dependency folder of an earlier backup made from the same lockfiles is hardlinked instead
+            cache = dep_cache(proj_fld, rule, options)
+            cached = cache.folder() if cache else None
+            pipeline = copier.CopyPipeline(options['io_threads'], resume=resume)
+            try:
+                with PROFILE.stage('walk'):
+                    if cached:
+                        s_print('copy', 'I', f'Same lockfiles as {cached}, linking it', uid, cnt=count)
+                        pipeline.copytree(cached, f'{part}/{dep_folder}', engine.link)
+                    else:
+                        pipeline.copytree(f'{proj_fld}/{dep_folder}', f'{part}/{dep_folder}', copy_tree_file)
+            finally:
+                with PROFILE.stage('copy'):
+                    dep_errors = pipeline.join()
+            errors += dep_errors
             s_print('copy', 'I', f'Done ({"%.2f" % (time.time() - start_dep_folder)}s): {dst}/{dep_folder}/', uid, cnt=count)
-            return utils.update_summ(summ, 0)
-        else:
-            return utils.update_summ(summ, 0)
+        if incremental:
+            incremental.save()
+            s_print('copy', 'I', f'Linked: {incremental.linked} - Copied: {incremental.copied}', uid, cnt=count)
+        if engine.report():
+            s_print('copy', 'I', f'Copy strategies: {engine.report()}', uid, cnt=count)
+        if errors:
+            for path, exc in errors:
+                s_print('copy', 'E', f'A problem happened while handling {path}: {exc}', uid, cnt=count)
+            s_print('copy', 'W', f'Incomplete copy, {len(errors)} element(s) failed: {part}/', uid, cnt=count)
+            return utils.job_summ(proj_fld, 1)
+        os.rename(part, dst)
+        if cache:
+            cache.record(f'{dst}/{dep_folder}')
+        s_print('copy', 'I', f'✅ Project duplicated ({"%.2f" % (time.time() - started)}s): {dst}/', uid, cnt=count)
+        return utils.job_summ(proj_fld, 0)
     except Exception as exc:
         s_print('copy', 'E', f'during the duplication {exc}', uid, cnt=count)
-        summ['failures'].append(proj_fld)
-        return utils.update_summ(summ, 1)
+        return utils.job_summ(proj_fld, 1)
+
+
+def store_backup(proj_fld, dst, rule, options, uid, started, count):
+    """Backs up a project into the deduplicating store, each chunk of data is only written once
+    :param proj_fld: string that represents the project folder we want to back up
+    :param dst: string that represents the destination the backup would have had, its name is used for the manifest
+    :param rule: dictionary/object representing the rule/language corresponding to the project
+    :param options: dictionary/object containing exclusion options
+    :param uid: text representing a short uid,
+    :param started: number representing the time when the script has been executed
+    """
+    import store
+    try:
+        exclusions = rule['actions']['exclude']
+        matcher = exclusion_matcher(proj_fld, exclusions, options, on_invalid=gitignore_warning('store', uid, count))
+        index = read_git_index(proj_fld, options, 'store', uid, count)
+        if index:
+            rel_paths = (rel for rel, _ in index.walk(matcher.excluded))
+        else:
+            rel_paths = store.walk(proj_fld, utils.get_files(proj_fld, matcher), matcher)
+        dep_folder = exclusions['dep_folder']
+        if options['dependencies'] and dep_folder and exists(f'{proj_fld}/{dep_folder}'):
+            # The matcher excludes the dependency folder, its content is walked without it like in duplicate()
+            rel_paths = itertools.chain(rel_paths, store.walk(proj_fld, [dep_folder]))
+        backup_store = store.Store(options['store'], options['compress_level'])
+        name = os.path.basename(dst)
+        with PROFILE.stage('store'):
+            backup_store.backup(
+                proj_fld, name, PROFILE.iterate('walk', rel_paths),
+                on_done=lambda rel: s_print('store', 'I', f'Done: {proj_fld}/{rel}', uid, cnt=count)
+            )
+        count_skipped(matcher)
+        PROFILE.count('store', 'new_chunks', backup_store.new_chunks)
+        PROFILE.count('store', 'reused_chunks', backup_store.reused_chunks)
+        PROFILE.count('store', 'bytes_written', backup_store.bytes_written)
+        s_print('store', 'I', f'New chunks: {backup_store.new_chunks} - Reused chunks: {backup_store.reused_chunks} - '
+                              f'Written: {backup_store.bytes_written} bytes', uid, cnt=count)
+        s_print('store', 'I', f'✅ Project stored ({"%.2f" % (time.time() - started)}s): {name}', uid, cnt=count)
+        return utils.job_summ(proj_fld, 0)
+    except Exception as exc:
+        s_print('store', 'E', f'during the backup {exc}', uid, cnt=count)
+        return utils.job_summ(proj_fld, 1)
+
+
+def backup_project(job):
+    """Detects the rule of a project if needed, then backs it up. Runs in a worker process when --jobs > 1.
+    An unexpected error only fails the project, the rest of the batch carries on
+    :param job: dictionary/object containing the project folder, its destination, its rule (or None) and the options
+    :return: The summary of this job only, meant to be merged into the summary of the run
+    """
+    try:
+        return run_job(job)
+    except Exception as exc:
+        operation = 'store' if job['options']['store'] else 'arch' if job['archive'] else 'copy'
+        s_print(operation, 'E', f'A problem happened while handling {job["proj_fld"]}: {exc}', job['uid'],
+                cnt=job['count'])
+        if job['journal']:
+            try:
+                job['journal'].write(job['proj_fld'], state='failed')
+            except OSError:
+                pass
+        result = utils.job_summ(job['proj_fld'], 1)
+        result['profile'] = PROFILE.collect()
+        result['progress'] = LOG.collect()
+        LOG.flush()
+        return result
+
+
+def run_job(job):
+    """
+    :param job: see backup_project()
+    :return: The summary of this job only
+    """
+    proj_fld = job['proj_fld']
+    uid = job['uid']
+    count = job['count']
+    elem_rule = job['rule']
+    detected = {}
+    # Worker processes don't share the profiler of the main process, what they record is sent back with the result
+    PROFILE.enabled = job['options']['profile']
+    LOG.mode, LOG.log_path = job['options']['output_mode'], job['options']['log_file']
+    if not elem_rule:
+        if not os.path.basename(proj_fld).startswith('.'):
+            ruleset = job['ruleset']
+            fingerprint = None
+            if not job['options']['no_cache']:
+                # If the project didn't change since its last detection, the cached rule is used right away
+                with PROFILE.stage('detect_stat'):
+                    fingerprint = ruleset.fingerprint(proj_fld)
+                if job['cached'] and job['cached'][1] == fingerprint:
+                    elem_rule = ruleset.get(job['cached'][0])
+                    if elem_rule:
+                        s_print('scan', 'I', f'Cached rule for {proj_fld}: {elem_rule["name"]}', uid, cnt=count)
+            if not elem_rule:
+                s_print('scan', 'I', f'Scanning {proj_fld}', uid, cnt=count)
+                elem_rule = auto_detect(proj_fld, ruleset, job['settings'], job['state'], uid)
+            if elem_rule and fingerprint:
+                detected[proj_fld] = [elem_rule['name'], fingerprint]
+        if not elem_rule:
+            s_print('scan', 'W',
+                    f'The folder {proj_fld} won\'t be processed as automatic rule detection failed',
+                    uid, cnt=count)
+            result = utils.update_summ(utils.new_summ(), 1)
+            result['ad_failures'].append(proj_fld)
+            if job['journal']:
+                job['journal'].write(proj_fld, state='failed')
+            result['profile'] = PROFILE.collect()
+            result['progress'] = LOG.collect()
+            LOG.flush()
+            return result
+
+    start_time = time.time()
+    if job['journal']:
+        # The rule is recorded so that a resumed run doesn't have to detect it again
+        job['journal'].write(proj_fld, state='running', rule=elem_rule['name'], dst=job['dst'])
+    if job['batch']:
+        operation = 'store' if job['options']['store'] else 'arch' if job['archive'] else 'copy'
+        s_print(operation, 'I', f'Processing: {proj_fld}', uid, cnt=count)
+    if job['options']['store']:
+        # If --store is provided to the script, the project goes into the deduplicating store
+        result = store_backup(proj_fld, job['dst'], elem_rule, job['options'], uid, start_time, count)
+    elif job['archive']:
+        # If --archive is provided to the script, we use make_archive()
+        result = make_archive(proj_fld, job['dst'], elem_rule, job['options'], uid, start_time, count)
+    else:
+        # Else if we don't want an archive we will do a copy of the project instead
+        result = duplicate(proj_fld, job['dst'], elem_rule, job['options'], uid, start_time, count, job['resume'])
+    if job['journal']:
+        job['journal'].write(proj_fld, state='failed' if result['failed'] else 'done')
+    result['detected'].update(detected)
+    result['profile'] = PROFILE.collect()
+    result['progress'] = LOG.collect()
+    LOG.flush()
+    return result
 
 
 @click.command()
@@ -357,7 +546,54 @@ def duplicate(proj_fld, dst, rule, options, uid, started, count):
 @click.option('-a', '--archive', default=False,
               help='Archives the project folder instead of making a copy of it',
               is_flag=True)
-def main(path, output, rule, dependencies, noexcl, nogit, keephidden, batch, archive):
+@click.option('-f', '--format', 'archive_format', default='zip', type=click.Choice(ARCHIVE_FORMATS),
+              help='Format of the archive when using --archive. tar.zst requires the zstandard package')
+@click.option('-cl', '--compress-level', default=9, type=click.IntRange(0, 9),
+              help='Compression level of the archive, from 0 (no compression) to 9')
+@click.option('-i', '--incremental', default=False,
+              help='Only copies the files that changed since the previous backup, the others are hardlinked. '
+                   'With zip archives, only compresses the files that changed since the previous archive',
+              is_flag=True)
+@click.option('-ck', '--checksum', default=False,
+              help='With --incremental, compares the files by hash instead of size and modification time',
+              is_flag=True)
+@click.option('-s', '--store', 'store_path', type=click.Path(),
+              help='Backs up the projects into a deduplicating store instead of copying or archiving them')
+@click.option('--restore',
+              help='Rebuilds a backup from the store given with --store, e.g. --restore project_171026073518')
+@click.option('-rg', '--respect-gitignore', default=False,
+              help='Also excludes the files and folders ignored by the .gitignore files of the project',
+              is_flag=True)
+@click.option('-gi', '--git-index', default=False,
+              help='In git repositories, sorts out the files with .git/index: the tracked files are kept, '
+                   'the untracked ones only when git doesn\'t ignore them',
+              is_flag=True)
+@click.option('-t', '--io-threads', default=4, type=click.IntRange(min=1),
+              help='Number of threads copying the files of a project')
+@click.option('-nc', '--no-cache', default=False,
+              help='Always runs the language detection, without using or updating the detection cache, '
+                   'and always copies the dependency folders in full',
+              is_flag=True)
+@click.option('--resume', 'resume_batch', default=False,
+              help='Resumes the last --batch run made with the same source and output folders: the projects it backed '
+                   'up are skipped, the others are backed up again, and the copies it started are completed',
+              is_flag=True)
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1),
+              help='Number of projects processed at the same time when using --batch')
+@click.option('-q', '--quiet', default=False,
+              help='Only prints the warnings and errors',
+              is_flag=True)
+@click.option('--progress', default=False,
+              help='Only prints the warnings, the errors and a progress line with the files and bytes processed',
+              is_flag=True)
+@click.option('--log-file', type=click.Path(),
+              help='Appends every message of the run to a file, as json lines')
+@click.option('--profile', default=False,
+              help='Prints the time spent in each stage of the run, along with their I/O counters',
+              is_flag=True)
+@click.option('--profile-json', type=click.Path(),
+              help='Writes the time spent in each stage of the run and their I/O counters into a json file')
+def main(path, output, rule, dependencies, noexcl, nogit, keephidden, batch, archive, archive_format, compress_level, incremental, checksum, store_path, restore, respect_gitignore, git_index, io_threads, no_cache, resume_batch, jobs, quiet, progress, log_file, profile, profile_json):
     """Dev projects backups made easy"""
 
     #####################
@@ -372,8 +608,23 @@ def main(path, output, rule, dependencies, noexcl, nogit, keephidden, batch, arc
         'noexcl': noexcl,
         'nogit': nogit,
         'keephidden': keephidden,
+        'compress_level': compress_level,
+        'format': archive_format,
+        'incremental': incremental,
+        'checksum': checksum,
+        'store': os.path.abspath(store_path) if store_path else None,
+        'output': os.path.abspath(output) if output else None,
+        'respect_gitignore': respect_gitignore,
+        'git_index': git_index,
+        'io_threads': io_threads,
+        'no_cache': no_cache,
+        'profile': bool(profile or profile_json),
+        'output_mode': 'progress' if progress else 'quiet' if quiet else 'normal',
+        'log_file': os.path.abspath(log_file) if log_file else None,
     }
-    global summ
+    LOG.configure(options['output_mode'], options['log_file'])
+    PROFILE.enabled = options['profile']
+    summ = utils.new_summ()
 
     #####################
     # Options validation
@@ -391,12 +642,44 @@ def main(path, output, rule, dependencies, noexcl, nogit, keephidden, batch, arc
         exit(0)
     if not path:
         curr_fld = os.getcwd()
+    if profile_json:
+        profile_json = os.path.abspath(profile_json)
     home = os.path.expanduser("~")
     os.chdir(f'{home}/.local/bin/shlerp/')
 
     with open(f'{os.getcwd()}/settings.json', 'r') as read_settings:
         settings = json.load(read_settings)
     uid = utils.suid()
+    try:
+        with PROFILE.stage('rules_load'):
+            ruleset = rules_index.load(f'{os.getcwd()}/rules.json')
+    except FileNotFoundError:
+        s_print('scan', 'E', 'rules.json not found', uid)
+        exit(1)
+
+    if archive and archive_format == 'tar.zst':
+        import archive as archiver
+        if not archiver.zstandard:
+            s_print('prep', 'E', 'tar.zst archives require the zstandard package (pip install zstandard)', uid)
+            exit(1)
+
+    if restore:
+        if not store_path:
+            s_print('store', 'E', '--restore requires --store', uid)
+            exit(1)
+        restore_dst = f'{options["output"] or curr_fld}/{restore}'
+        try:
+            import store
+            restored = store.Store(options['store']).restore(restore, restore_dst)
+        except (OSError, ValueError) as exc:
+            s_print('store', 'E', f'during the restoration {exc}', uid)
+            exit(1)
+        s_print('store', 'I', f'✅ Restored {restored} elements ({"%.2f" % (time.time() - exec_time)}s): {restore_dst}/', uid)
+        exit(0)
+
+    if resume_batch and not batch:
+        s_print('prep', 'E', '--resume requires --batch', uid)
+        exit(1)
 
     if batch and not output:
         u_input = s_print('prep', 'W', 'You are about to backup your projects in the same folder. Continue (Y/N)? ',
@@ -413,53 +696,28 @@ def main(path, output, rule, dependencies, noexcl, nogit, keephidden, batch, arc
     def get_sources(**kwargs):
         batch_list = []
         if batch:
-            batch_list = [f'{curr_fld}/{f}' for f in os.listdir(curr_fld)]
+            import depcache
+            # The dependency cache of a batch whose output is its source folder isn't a project
+            batch_list = [f'{curr_fld}/{f}' for f in os.listdir(curr_fld) if f != depcache.CACHE_NAME]
         else:
             batch_list.append(curr_fld)
 
         for batch_elem in batch_list:
-            elem_rule = None
             if os.path.isdir(batch_elem):
-                if len(kwargs) > 0 and kwargs['rule']:
-                    elem_rule = kwargs['rule']
-                else:
-                    if not batch_elem.startswith('.'):
-                        s_print('scan', 'I', f'Scanning {batch_elem}', uid)
-                        elem_rule = auto_detect(batch_elem, settings, uid)
-                if elem_rule:
-                    backup_sources.append({
-                        'proj_fld': batch_elem,
-                        'rule': elem_rule
-                    })
-                else:
-                    s_print('scan', 'W',
-                            f'The folder {batch_elem} won\'t be processed as automatic rule detection failed',
-                            uid)
-                    summ.update(utils.update_summ(summ, 1))
-                    summ['ad_failures'].append(batch_elem)
-                    summ['total'] += 1
-        echo('------------')
+                backup_sources.append({
+                    'proj_fld': batch_elem,
+                    'rule': kwargs['rule'] if len(kwargs) > 0 else None
+                })
 
     if not rule:
         get_sources()
     else:
         # If a --rule has been provided by the user, check if it is valid
-        with open(f'{os.getcwd()}/rules.json', 'r') as read_file:
-            rules = json.load(read_file)
-            match = False
-            for stored_rule in rules:
-                if stored_rule['name'].lower() == str(rule).lower():
-                    if batch:
-                        get_sources(rule=stored_rule)
-                    else:
-                        backup_sources.append({
-                            'proj_fld': curr_fld,
-                            'rule': stored_rule
-                        })
-                    match = True
-            if not match:
-                s_print('scan', 'E', 'Rule name not found', uid)
-                exit(0)
+        stored_rule = ruleset.get(rule)
+        if not stored_rule:
+            s_print('scan', 'E', 'Rule name not found', uid)
+            exit(0)
+        get_sources(rule=stored_rule)
 
     # At this point we should have a list containing at least one project to process
 
@@ -475,51 +733,122 @@ def main(path, output, rule, dependencies, noexcl, nogit, keephidden, batch, arc
 
     # At this point we should have the dst incorporated into the backup_job list
 
-    summ['total'] += len(backup_sources)
-    for backup in backup_sources:
-        start_time = time.time()
-        show_summ = [True if summ['total'] > 1 else False]
-        count = ''
-        if show_summ:
-            count = f'{summ["done"] + summ["failed"]}/{summ["total"]}'
-        # payload = {
-        #     'source': backup['proj_fld'], 'dest': backup['dst'],
-        #     'rule': backup['rule'], 'options': options,
-        #     'uid': uid, 'start_time': start_time,
-        #     'summ': summ
-        # }
-        if batch:
-            s_print('arch' if archive else 'copy', 'I', f'Processing: {backup["proj_fld"]}', uid, cnt=count)
-        if archive:
-            # If --archive is provided to the script, we use make_archive()
-            summ = make_archive(
-                backup['proj_fld'], backup['dst'],
-                backup['rule'], options,
-                uid, start_time, count
-            )
-            # summ = make_archive(payload)
-
-        else:
-            # Else if we don't want an archive we will do a copy of the project instead
-            summ = duplicate(
-                backup['proj_fld'], backup['dst'],
-                backup['rule'], options,
-                uid, start_time, count
-            )
-            # summ = duplicate(payload)
-
-        if batch:
+    # A batch run records the state of its projects in a journal, in the folder receiving the backups
+    run_journal = None
+    skipped = []
+    if batch:
+        import journal
+        run_journal = journal.Journal(f'{output or curr_fld}/{journal.JOURNAL_NAME}')
+        operation = 'store' if store_path else 'arch' if archive else 'copy'
+        run = {'uid': uid, 'source': curr_fld, 'operation': operation, 'format': archive_format}
+        carried = []
+        if resume_batch:
+            last_run, projects = run_journal.read()
+            if [last_run.get(key) for key in ('source', 'operation', 'format')] != [curr_fld, operation, archive_format]:
+                s_print('prep', 'W', 'No earlier run of this batch to resume, every project is backed up', uid)
+                projects = {}
+            remaining = []
+            for backup in backup_sources:
+                entry = projects.get(backup['proj_fld'])
+                if not entry:
+                    remaining.append(backup)
+                    continue
+                # Interrupted between the renaming of the backup and its record
+                renamed = entry.get('state') == 'running' and operation != 'store' and \
+                    exists(f'{entry["dst"]}.{archive_format}' if archive else entry['dst'])
+                if entry.get('state') == 'done' or renamed:
+                    s_print('prep', 'I', f'Already backed up: {entry["dst"]}', uid)
+                    carried.append({'project': backup['proj_fld'], 'state': 'done', 'dst': entry['dst']})
+                    skipped.append(backup)
+                    continue
+                # The same destination is used again, so that a copy that was started is completed
+                backup.update({'dst': entry.get('dst') or backup['dst'], 'resume': True})
+                if not backup['rule'] and entry.get('rule'):
+                    backup['rule'] = ruleset.get(entry['rule'])
+                remaining.append(backup)
+            backup_sources = remaining
+        run_journal.start(run, carried + [
+            {'project': backup['proj_fld'], 'state': 'pending', 'dst': backup['dst']} for backup in backup_sources
+        ])
+
+    # The rules history shared by all the shlerp runs
+    state = StateStore(f'{os.getcwd()}/tmp.json')
+    detection_cache = rules_index.DetectionCache(
+        f'{os.getcwd()}/detect_cache.json', settings['rules'].get('cache_limit', 500)
+    )
+    summ['total'] = len(backup_sources) + len(skipped)
+    summ['done'] = len(skipped)
+    for index, backup in enumerate(backup_sources, len(skipped)):
+        backup.setdefault('resume', False)
+        backup.update({
+            'cached': None if no_cache else detection_cache.get(backup['proj_fld']),
+            'state': state,
+            'ruleset': ruleset,
+            'settings': settings,
+            'options': options,
+            'uid': uid,
+            'batch': batch,
+            'archive': archive,
+            'journal': run_journal,
+            'count': f'{index}/{summ["total"]}' if summ['total'] > 1 else ''
+        })
+
+    # Set aside so that the forked workers don't report what the main process recorded so far
+    main_stages = PROFILE.collect()
+    LOG.flush()
+    LOG.projects_total = summ['total']
+    if jobs > 1 and len(backup_sources) > 1:
+        # Each project is detected and backed up in its own process, the results are merged as they come
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for result in executor.map(backup_project, backup_sources):
+                utils.merge_summ(summ, result)
+                PROFILE.merge(result['profile'])
+                LOG.merge(result['progress'])
+                LOG.project_done(summ['done'], summ['failed'])
+    else:
+        for backup in backup_sources:
+            result = backup_project(backup)
+            utils.merge_summ(summ, result)
+            PROFILE.merge(result['profile'])
+            LOG.merge(result['progress'])
+            LOG.project_done(summ['done'], summ['failed'])
+    PROFILE.merge(main_stages)
+    if summ['detected']:
+        detection_cache.update(summ['detected'])
+        detection_cache.save()
+
+    LOG.finish()
+    if batch:
+        if LOG.mode == 'normal':
             echo('------------')
-            if summ['done'] + summ['failed'] == summ['total']:
-                summary = f'Successful: {summ["done"]}, - ' \
-                          f'Failed: {summ["failed"]}, - ' \
-                          f'Total runtime: {"%.2f" % (time.time() - exec_time)}s'
-                operation = 'arch' if archive else 'copy'
-                s_print(operation, 'I', summary, uid)
-                if summ['failed'] > 0 and len(summ['failures']) > 0:
-                    s_print(operation, 'W', f'Operation failures: {summ["failures"]}', uid)
-                if len(summ['ad_failures']) > 0:
-                    s_print(operation, 'W', f'Detection failures: {summ["ad_failures"]}', uid)
+        summary = f'Successful: {summ["done"]}, - ' \
+                  f'Failed: {summ["failed"]}, - ' \
+                  f'Total runtime: {"%.2f" % (time.time() - exec_time)}s'
+        operation = 'store' if store_path else 'arch' if archive else 'copy'
+        s_print(operation, 'I', summary, uid)
+        if summ['failed'] > 0 and len(summ['failures']) > 0:
+            s_print(operation, 'W', f'Operation failures: {summ["failures"]}', uid)
+        if len(summ['ad_failures']) > 0:
+            s_print(operation, 'W', f'Detection failures: {summ["ad_failures"]}', uid)
+
+    LOG.flush()
+    if profile:
+        echo('------------')
+        for line in PROFILE.report():
+            echo(line)
+    if profile_json:
+        try:
+            with open(profile_json, 'w') as write_profile:
+                json.dump({
+                    'uid': uid,
+                    'total_wall': time.time() - exec_time,
+                    'jobs': jobs,
+                    'io_threads': io_threads,
+                    'stages': PROFILE.stages
+                }, write_profile, indent=4)
+        except OSError as exc:
+            s_print('prep', 'E', f'Unable to write the profile: {exc}', uid)
 
 
 if __name__ == '__main__':
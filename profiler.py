@@ -0,0 +1,165 @@
+"""Stage profiler
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import time
+import threading
+from contextlib import nullcontext
+
+# The order in which the stages are reported, the others come after them
+STAGES = ('rules_load', 'detect_stat', 'detect_crawl', 'walk', 'filter', 'copy', 'compress', 'store', 'fsync')
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+
+    def __exit__(self, *exc):
+        self.profiler._exit()
+
+
+class Profiler:
+    """Records the wall time, the CPU time and a few counters for each stage of a run.
+    Stages don't overlap: when a stage is entered from another one, the time spent in the inner stage is only
+    counted for the inner stage. The CPU time is the one of the whole process while the stage ran, which includes
+    the threads copying or compressing files on its behalf: a stage whose CPU time is far below its wall time
+    is waiting for the disk.
+    Does nothing until it is enabled, so that the instrumented code doesn't slow down regular runs"""
+
+    def __init__(self):
+        self.enabled = False
+        # stage name -> {'calls': number, 'wall': seconds, 'cpu': seconds, 'counters': {name: number}}
+        self.stages = {}
+        self.lock = threading.Lock()
+        # Each thread has its own stack of [stage name, wall clock, cpu clock]
+        self.local = threading.local()
+
+    def stage(self, name):
+        """
+        :param name: text, the name of the stage
+        :return: A context manager that measures the code it wraps
+        """
+        return _Stage(self, name) if self.enabled else nullcontext()
+
+    def wrap(self, name, func):
+        """
+        :param name: text, the name of the stage
+        :param func: the function we want to measure
+        :return: The function, measured on every call when the profiler is enabled
+        """
+        if not self.enabled:
+            return func
+
+        def wrapped(*args, **kwargs):
+            with _Stage(self, name):
+                return func(*args, **kwargs)
+        return wrapped
+
+    def iterate(self, name, iterable):
+        """Measures the time spent producing each element of an iterable, e.g. a walk interleaved with writes
+        :param name: text, the name of the stage
+        :param iterable: the iterable we want to measure
+        :return: A generator of the elements of the iterable
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with _Stage(self, name):
+                try:
+                    elem = next(iterator)
+                except StopIteration:
+                    return
+            yield elem
+
+    def count(self, name, counter, amount=1):
+        """
+        :param name: text, the name of the stage
+        :param counter: text, the name of the counter, e.g. bytes_read
+        :param amount: (optional) number added to the counter
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            counters = self._entry(name)['counters']
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def collect(self):
+        """
+        :return: The data recorded so far, which is then cleared
+        """
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages):
+        """Adds the data recorded by another process, e.g. a --jobs worker
+        :param stages: the data returned by collect()
+        """
+        with self.lock:
+            for name, data in stages.items():
+                entry = self._entry(name)
+                for key in ('calls', 'wall', 'cpu'):
+                    entry[key] += data[key]
+                for counter, amount in data['counters'].items():
+                    entry['counters'][counter] = entry['counters'].get(counter, 0) + amount
+
+    def report(self):
+        """
+        :return: The lines of a table summarizing the stages
+        """
+        names = [name for name in STAGES if name in self.stages]
+        names += sorted(name for name in self.stages if name not in STAGES)
+        lines = [f'{"Stage":<14}{"Calls":>9}{"Wall":>11}{"CPU":>11}{"CPU%":>7}  Counters']
+        for name in names:
+            data = self.stages[name]
+            usage = f'{data["cpu"] / data["wall"]:.0%}' if data['wall'] else '-'
+            counters = ', '.join(f'{counter}: {amount}' for counter, amount in sorted(data['counters'].items()))
+            lines.append(
+                f'{name:<14}{data["calls"]:>9}{data["wall"]:>10.3f}s{data["cpu"]:>10.3f}s{usage:>7}  {counters}'
+            )
+        return lines
+
+    def _entry(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'counters': {}}
+        return self.stages[name]
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _enter(self, name):
+        stack = self._stack()
+        now, cpu = time.perf_counter(), time.process_time()
+        if stack:
+            # The outer stage is paused while the inner one runs
+            self._add(stack[-1], now, cpu)
+        stack.append([name, now, cpu])
+        with self.lock:
+            self._entry(name)['calls'] += 1
+
+    def _exit(self):
+        stack = self._stack()
+        now, cpu = time.perf_counter(), time.process_time()
+        self._add(stack.pop(), now, cpu)
+        if stack:
+            stack[-1][1], stack[-1][2] = now, cpu
+
+    def _add(self, frame, now, cpu):
+        name, wall_start, cpu_start = frame
+        with self.lock:
+            entry = self._entry(name)
+            entry['wall'] += now - wall_start
+            entry['cpu'] += cpu - cpu_start
+
+
+# Shared by the whole process, enabled with --profile or --profile-json
+PROFILE = Profiler()
@@ -0,0 +1,313 @@
+"""Compiled ruleset
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import re
+import json
+from collections import OrderedDict
+from os.path import exists
+import utils
+from state import StateStore
+from profiler import PROFILE
+
+# Bump this number whenever the layout of the Ruleset object changes so that old caches get rebuilt
+CACHE_VERSION = 3
+
+
+def compile_pattern(file):
+    """
+    :param file: a file object of the "detect" section of a rule
+    :return: The pattern as bytes, or as a compiled regex when "regex" is set to true, None if there is no pattern
+    """
+    if not file['pattern']:
+        return None
+    if file.get('regex'):
+        return re.compile(file['pattern'].encode())
+    return file['pattern'].encode()
+
+
+class Ruleset:
+    """Index of rules.json, built once per run so that the detection doesn't have to go through the json again"""
+
+    def __init__(self, rules, digest=None):
+        """
+        :param rules: List of objects representing the rules, as stored in rules.json
+        :param digest: (optional) text, the hash of the rules.json content
+        """
+        self.hash = digest
+        # name -> rule
+        self.rules = {}
+        # exact filename -> [(rule name, weight, pattern, byte limit)]
+        self.files = {}
+        # extension (e.g. '.py') -> [(rule name, weight)]
+        self.extensions = {}
+        # folder -> [(rule name, files, weight)]
+        self.folders = {}
+        self.dep_folders = set()
+        # The first chunk of the paths above -> the paths, so that they can be intersected with a directory listing
+        self.file_roots = {}
+        self.folder_roots = {}
+        for rule in rules:
+            name = rule['name']
+            self.rules[name] = rule
+            for file in rule['detect']['files']:
+                names = file['name']
+                for file_name in names:
+                    if file_name.startswith('*.'):
+                        self.extensions.setdefault(file_name[1:], []).append((name, file['weight']))
+                    else:
+                        # Patterns are only evaluated when a file object declares a single file name
+                        pattern = compile_pattern(file) if len(names) == 1 else None
+                        self.files.setdefault(file_name, []).append((
+                            name, file['weight'], pattern, rule['detect'].get('pattern_limit')
+                        ))
+                        self.file_roots.setdefault(file_name.split('/')[0], {})[file_name] = None
+            for folder in rule['detect']['folders']:
+                folder_name = folder['name'].strip('/')
+                self.folders.setdefault(folder_name, []).append((name, tuple(folder['files']), folder['weight']))
+                self.folder_roots.setdefault(folder_name.split('/')[0], {})[folder_name] = None
+            if rule['actions']['exclude']['dep_folder']:
+                self.dep_folders.add(rule['actions']['exclude']['dep_folder'])
+        self.names = list(self.rules)
+
+    def get(self, name):
+        """Case-insensitive rule lookup
+        :param name: text, the name of the rule
+        :return: A copy of the rule, or None if it doesn't exist
+        """
+        import copy
+        for rule_name in self.names:
+            if rule_name.lower() == str(name).lower():
+                return copy.deepcopy(self.rules[rule_name])
+        return None
+
+    def lead(self, name, total=0):
+        """Builds a potential winner out of a rule
+        :param name: text, the name of the rule
+        :param total: number, the weight found so far for this rule
+        :return: A copy of the rule, with its total and the extensions to crawl
+        """
+        import copy
+        lead = copy.deepcopy(self.rules[name])
+        lead['total'] = total
+        lead['extensions'] = [
+            {'name': f'*{ext}', 'weight': weight}
+            for ext, entries in self.extensions.items()
+            for rule_name, weight in entries if rule_name == name
+        ]
+        return lead
+
+    def score(self, proj_fld, names):
+        """Weighs the given rules against the root of a project. The cheapest checks are done first, and the
+        scoring stops as soon as the leader can't be caught up by the weight any other rule could still get
+        :param proj_fld: text, the folder we want to process
+        :param names: the names of the rules we want to evaluate
+        :return: A list of leads, in the same order as in rules.json
+        """
+        names = set(names)
+        totals = dict.fromkeys(names, 0)
+        try:
+            listing = set(os.listdir(proj_fld))
+        except OSError:
+            listing = set()
+
+        # Files found at the root of the project don't cost anything more than the listing itself,
+        # the other checks are queued as (cost, rule name, weight, check, arguments)
+        checks = []
+        for root in listing & self.file_roots.keys():
+            for file_name in self.file_roots[root]:
+                path = f'{proj_fld}/{file_name}'
+                for rule_name, weight, pattern, limit in self.files[file_name]:
+                    if rule_name not in names:
+                        continue
+                    if pattern:
+                        # If the pattern defined in the rule is not set to null, search it in the file
+                        checks.append((2, rule_name, weight, self._pattern_found, (path, pattern, limit)))
+                    elif file_name == root:
+                        totals[rule_name] += weight
+                    else:
+                        checks.append((1, rule_name, weight, self._exists, (path,)))
+        for root in listing & self.folder_roots.keys():
+            for folder_name in self.folder_roots[root]:
+                for rule_name, files, weight in self.folders[folder_name]:
+                    if rule_name in names:
+                        # Make sure that each files from the folder element exists before increasing the weight
+                        paths = (f'{proj_fld}/{folder_name}/', *(f'{proj_fld}/{folder_name}/{file}' for file in files))
+                        checks.append((1, rule_name, weight, self._all_exist, paths))
+        checks.sort(key=lambda check: check[0])
+
+        remaining = dict.fromkeys(names, 0)
+        for _, rule_name, weight, _, _ in checks:
+            remaining[rule_name] += weight
+        self._stats = {}
+        for _, rule_name, weight, check, args in checks:
+            if self._decided(totals, remaining):
+                break
+            remaining[rule_name] -= weight
+            if check(*args):
+                totals[rule_name] += weight
+
+        return [self.lead(name, totals[name]) for name in self.names if name in names]
+
+    @staticmethod
+    def _decided(totals, remaining):
+        """
+        :return: True if the leader has more weight than any other rule could reach
+        """
+        if len(totals) < 2:
+            return not any(remaining.values())
+        leader = max(totals, key=totals.get)
+        if totals[leader] <= 0:
+            return False
+        return all(totals[leader] > totals[name] + remaining[name] for name in totals if name != leader)
+
+    def _exists(self, path):
+        # The same paths are often checked by several rules
+        if path not in self._stats:
+            PROFILE.count('detect_stat', 'stat_calls')
+            self._stats[path] = exists(path)
+        return self._stats[path]
+
+    def _all_exist(self, *paths):
+        return all(self._exists(path) for path in paths)
+
+    def _pattern_found(self, path, pattern, limit):
+        PROFILE.count('detect_stat', 'files_read')
+        try:
+            return utils.pattern_found(path, pattern, limit)
+        except OSError:
+            return False
+
+    def fingerprint(self, proj_fld):
+        """Cheap summary of what the detection depends on: the listing of the project root,
+        the modification time of the files and folders of the ruleset found there, and the ruleset itself
+        :param proj_fld: text, the project folder
+        :return: A hex digest that changes whenever the detection may give another result,
+        or None if the project can't be listed
+        """
+        import hashlib
+        digest = hashlib.sha1((self.hash or '').encode())
+        try:
+            names = sorted(os.listdir(proj_fld))
+        except OSError:
+            return None
+        for name in names:
+            digest.update(name.encode(errors='surrogateescape') + b'\0')
+            if name in self.file_roots or name in self.folder_roots:
+                PROFILE.count('detect_stat', 'stat_calls')
+                try:
+                    mtime = os.stat(f'{proj_fld}/{name}').st_mtime_ns
+                except OSError:
+                    # Removed since the listing, or a broken link
+                    mtime = None
+                digest.update(str(mtime).encode() + b'\0')
+        return digest.hexdigest()
+
+
+class DetectionCache:
+    """Remembers which rule has been elected for each project, along with the fingerprint of the project
+    at that time. The least recently used projects are evicted first.
+    The cache file is shared by concurrent shlerp runs, it is written through a StateStore"""
+
+    def __init__(self, path, limit=500):
+        """
+        :param path: text, the location of the cache file
+        :param limit: number, the maximum number of projects kept in the cache
+        """
+        self.store = StateStore(path)
+        self.limit = limit
+        # project folder -> [rule name, fingerprint], the most recently used last
+        self.entries = self._entries(self.store.load())
+        # The entries updated by this run, which are the only ones written back into the file
+        self.updated = {}
+
+    @staticmethod
+    def _entries(data):
+        entries = OrderedDict()
+        try:
+            for proj_fld, rule_name, fingerprint in data.get('projects', []):
+                entries[proj_fld] = [rule_name, fingerprint]
+        except (ValueError, TypeError):
+            pass
+        return entries
+
+    def get(self, proj_fld):
+        """
+        :param proj_fld: text, the project folder
+        :return: The [rule name, fingerprint] stored for the project, or None
+        """
+        return self.entries.get(proj_fld)
+
+    def update(self, detected):
+        """
+        :param detected: dictionary mapping project folders to [rule name, fingerprint]
+        """
+        self.updated.update(detected)
+        self._merge(self.entries, detected)
+
+    def _merge(self, entries, detected):
+        for proj_fld, entry in detected.items():
+            entries[proj_fld] = list(entry)
+            entries.move_to_end(proj_fld)
+        while len(entries) > self.limit:
+            entries.popitem(last=False)
+
+    def save(self):
+        """Merges the entries updated by this run into the cache file, so that the ones written by the other runs
+        since it was read are kept
+        :return: True if the cache file has been written
+        """
+        def apply(data):
+            entries = self._entries(data)
+            self._merge(entries, self.updated)
+            data['projects'] = [[path, *entry] for path, entry in entries.items()]
+            self.entries = entries
+        return self.store.update(apply)
+
+
+def load(rules_path):
+    """Loads the ruleset, from its cache whenever rules.json hasn't changed
+    The cache is stored next to rules.json and is keyed by the mtime and the hash of the file
+    :param rules_path: text, the location of rules.json
+    :return: A Ruleset object
+    """
+    # Neither of these is needed to import the module, which main.py does at startup
+    import pickle
+    import hashlib
+    cache_path = f'{os.path.splitext(rules_path)[0]}.cache'
+    stat = os.stat(rules_path)
+    try:
+        with open(cache_path, 'rb') as read_cache:
+            cached = pickle.load(read_cache)
+        if cached['version'] != CACHE_VERSION:
+            cached = None
+        elif cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            return cached['ruleset']
+    except Exception:
+        cached = None
+
+    with open(rules_path, 'rb') as read_file:
+        raw = read_file.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    if cached and cached['hash'] == digest:
+        ruleset = cached['ruleset']
+    else:
+        ruleset = Ruleset(json.loads(raw), digest)
+
+    # The cache is only an optimization, the run goes on if it can't be written
+    try:
+        tmp_path = f'{cache_path}.{os.getpid()}'
+        with open(tmp_path, 'wb') as write_cache:
+            pickle.dump({
+                'version': CACHE_VERSION,
+                'mtime': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'hash': digest,
+                'ruleset': ruleset
+            }, write_cache)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return ruleset
@@ -14,6 +14,18 @@ def setup():
         'rules.json',
         'settings.json',
         'utils.py',
+        'ruleset.py',
+        'archive.py',
+        'snapshot.py',
+        'store.py',
+        'copier.py',
+        'state.py',
+        'profiler.py',
+        'logs.py',
+        'gitignore.py',
+        'gitindex.py',
+        'depcache.py',
+        'journal.py',
         'function.template'
     )
     with open(f'{os.getcwd()}/settings.json', 'r') as read_settings:
@@ -0,0 +1,132 @@
+"""Incremental snapshots
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import json
+import shutil
+import hashlib
+import threading
+from datetime import datetime
+from os.path import exists, join
+from profiler import PROFILE
+from logs import LOG
+
+# Stored at the root of each snapshot, maps every copied file to the state of its source
+MANIFEST_NAME = '.shlerp_manifest.json'
+
+
+def file_hash(path):
+    """
+    :param path: text, the file we want to hash
+    :return: The BLAKE2 digest of the file, in hex
+    """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as read_file:
+        for chunk in iter(lambda: read_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_previous(dst):
+    """Finds the newest earlier snapshot of a project, stored in the same folder as the new one
+    :param dst: text, the destination of the new snapshot, e.g. /backups/project_171026073518
+    :return: The path of the previous snapshot, or None if there is none
+    """
+    parent, name = os.path.split(dst.rstrip('/'))
+    project = name.rpartition('_')[0]
+    candidates = []
+    try:
+        entries = list(os.scandir(parent))
+    except OSError:
+        return None
+    for entry in entries:
+        prefix, _, stamp = entry.name.rpartition('_')
+        if prefix != project or entry.path == dst or not entry.is_dir():
+            continue
+        try:
+            taken = datetime.strptime(stamp, '%d%m%y%H%M%S')
+        except ValueError:
+            continue
+        if exists(join(entry.path, MANIFEST_NAME)):
+            candidates.append((taken, entry.path))
+    return max(candidates)[1] if candidates else None
+
+
+class Snapshot:
+    """Copy function for shutil.copytree that hardlinks the files that didn't change since the previous snapshot,
+    rsnapshot style, and only copies the others"""
+
+    def __init__(self, proj_fld, dst, previous=None, checksum=False, copy_function=shutil.copy, known_hash=None):
+        """
+        :param proj_fld: text, the project folder we want to duplicate
+        :param dst: text, the folder of the new snapshot
+        :param previous: (optional) text, the folder of the previous snapshot
+        :param checksum: (optional) compare the files by hash instead of modification time
+        :param copy_function: (optional) function used to copy the files that changed
+        :param known_hash: (optional) function called with (relative path, os.stat_result), returning a hash of the
+        file when it is already known, e.g. gitindex.Index.clean_hash, or None when the file has to be read
+        """
+        self.proj_fld = proj_fld
+        self.dst = dst
+        self.previous = previous
+        self.checksum = checksum
+        self.manifest = {}
+        self.old_manifest = {}
+        self.copy_function = copy_function
+        self.known_hash = known_hash
+        self.linked = self.copied = 0
+        # Files may be copied by the threads of a CopyPipeline
+        self.lock = threading.Lock()
+        if previous:
+            try:
+                with open(join(previous, MANIFEST_NAME), 'r') as read_manifest:
+                    self.old_manifest = json.load(read_manifest)
+            except (OSError, ValueError):
+                self.previous = None
+
+    def unchanged(self, old, new):
+        """
+        :param old: the manifest entry of the previous snapshot, [size, mtime_ns, hash]
+        :param new: the manifest entry of the current file
+        :return: True if the file can be linked from the previous snapshot
+        """
+        if self.checksum:
+            return old[0] == new[0] and old[2] is not None and old[2] == new[2]
+        return old[0] == new[0] and old[1] == new[1]
+
+    def copy(self, src, dst):
+        """Copies or links a single file, with the same signature as shutil.copy
+        :param src: text, the source file
+        :param dst: text, the destination file
+        :return: The destination file
+        """
+        rel = os.path.relpath(src, self.proj_fld)
+        st = os.stat(src)
+        digest = None
+        if self.checksum:
+            digest = (self.known_hash and self.known_hash(rel, st)) or file_hash(src)
+        entry = [st.st_size, st.st_mtime_ns, digest]
+        self.manifest[rel] = entry
+        old = self.old_manifest.get(rel)
+        if old and self.unchanged(old, entry):
+            try:
+                os.link(join(self.previous, rel), dst)
+                with self.lock:
+                    self.linked += 1
+                PROFILE.count('copy', 'files_linked')
+                LOG.advance(1, entry[0])
+                return dst
+            except OSError:
+                # The previous copy has been removed, or it is on another device
+                pass
+        self.copy_function(src, dst)
+        with self.lock:
+            self.copied += 1
+        return dst
+
+    def save(self):
+        """Writes the manifest at the root of the snapshot"""
+        with open(join(self.dst, MANIFEST_NAME), 'w') as write_manifest:
+            json.dump(self.manifest, write_manifest)
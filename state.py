@@ -0,0 +1,108 @@
+"""State store
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import json
+import time
+from contextlib import contextmanager
+from profiler import PROFILE
+
+# Advisory locks are only available on Unix, which is all shlerp supports anyway
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class StateStore:
+    """Small json store shared by concurrent shlerp runs (e.g. cron and an interactive run).
+    It is read once per process, and every update happens under an exclusive lock: the file is read again,
+    modified, then written into a temporary file that is moved over the previous one"""
+
+    def __init__(self, path):
+        """
+        :param path: text, the location of the state file, e.g. tmp.json in the install folder
+        """
+        self.path = path
+        self.lock_path = f'{path}.lock'
+        self.data = None
+
+    @contextmanager
+    def locked(self, exclusive):
+        if not fcntl:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as read_state:
+                data = json.load(read_state)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        # The history used to be a list of rule names, the most recent first
+        history = data.get('rules_history')
+        if isinstance(history, list):
+            data['rules_history'] = {
+                name: {'hits': len(history) - index, 'last': 0} for index, name in enumerate(history)
+            }
+        return data
+
+    def load(self):
+        """
+        :return: The content of the state file, only read once per process
+        """
+        if self.data is None:
+            with self.locked(False):
+                self.data = self._read()
+        return self.data
+
+    def update(self, apply):
+        """Modifies the state file atomically
+        :param apply: function called with the current content of the state file, which it modifies in place
+        :return: True if the state file has been written
+        """
+        try:
+            with self.locked(True):
+                data = self._read()
+                apply(data)
+                tmp_path = f'{self.path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as write_state:
+                    json.dump(data, write_state, indent=4)
+                    write_state.flush()
+                    with PROFILE.stage('fsync'):
+                        os.fsync(write_state.fileno())
+                os.replace(tmp_path, self.path)
+        except OSError:
+            return False
+        self.data = data
+        return True
+
+    def history(self, limit):
+        """
+        :param limit: number, the maximum number of rule names to return
+        :return: The names of the rules that were elected the most often, the most recent first on equal hits
+        """
+        history = self.load().get('rules_history', {})
+        ranked = sorted(history.items(), key=lambda item: (item[1]['hits'], item[1]['last']), reverse=True)
+        return [name for name, _ in ranked[:limit]]
+
+    def record_hit(self, rule_name):
+        """Counts one more election for a rule
+        :param rule_name: text, the name of the elected rule
+        :return: True if the state file has been written
+        """
+        def apply(data):
+            entry = data.setdefault('rules_history', {}).setdefault(rule_name, {'hits': 0, 'last': 0})
+            entry['hits'] += 1
+            entry['last'] = time.time()
+        return self.update(apply)
@@ -0,0 +1,159 @@
+"""Deduplicating backup store
+Copyright (c) 2023 Mathieu BARBE-GAYET
+All Rights Reserved.
+Released under the GNU Affero General Public License v3.0
+"""
+import os
+import json
+import stat
+import zlib
+import hashlib
+from os.path import exists, join
+from logs import LOG
+
+# Files are split in fixed-size chunks, so that identical files and identical prefixes are only stored once
+CHUNK_SIZE = 1024 * 1024
+
+
+def walk(proj_fld, elem_list, matcher=None):
+    """Lists every element below the given top-level elements of a project
+    :param proj_fld: text, the project folder
+    :param elem_list: list of the top-level elements we want to keep, as returned by utils.get_files()
+    :param matcher: (optional) utils.ExclusionMatcher, the excluded elements are skipped
+    :return: A generator of paths relative to the project folder
+    """
+    for elem in elem_list:
+        yield elem
+        path = join(proj_fld, elem)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                rel_root = os.path.relpath(root, proj_fld)
+                if matcher:
+                    # Pruned in place so that os.walk doesn't descend into the excluded folders
+                    dirs[:] = [name for name in dirs if not matcher.excluded(f'{rel_root}/{name}', True)]
+                    files = [name for name in files if not matcher.excluded(f'{rel_root}/{name}')]
+                for name in dirs + files:
+                    yield f'{rel_root}/{name}'
+
+
+class Store:
+    """Content-addressed store: every chunk is hashed with BLAKE2 and written once into the packs folder,
+    each backup is recorded as a small manifest that lists the chunks of its files"""
+
+    def __init__(self, path, level=6):
+        """
+        :param path: text, the folder of the store
+        :param level: number, the zlib compression level of the chunks
+        """
+        self.path = path
+        self.level = level
+        self.new_chunks = self.reused_chunks = self.bytes_written = 0
+        os.makedirs(join(path, 'packs'), exist_ok=True)
+        os.makedirs(join(path, 'manifests'), exist_ok=True)
+
+    def chunk_path(self, digest):
+        return join(self.path, 'packs', digest[:2], digest)
+
+    def put_chunk(self, data):
+        """Writes a chunk unless it is already in the store
+        :param data: bytes, the content of the chunk
+        :return: The digest of the chunk
+        """
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        path = self.chunk_path(digest)
+        if exists(path):
+            self.reused_chunks += 1
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = zlib.compress(data, self.level)
+        # Written under a temporary name first, so that concurrent runs never see half-written chunks
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as write_chunk:
+            write_chunk.write(compressed)
+        os.replace(tmp_path, path)
+        self.new_chunks += 1
+        self.bytes_written += len(compressed)
+        return digest
+
+    def get_chunk(self, digest):
+        with open(self.chunk_path(digest), 'rb') as read_chunk:
+            return zlib.decompress(read_chunk.read())
+
+    def put_file(self, path):
+        """
+        :param path: text, the file we want to store
+        :return: The list of the digests of its chunks
+        """
+        chunks = []
+        with open(path, 'rb') as read_file:
+            for data in iter(lambda: read_file.read(CHUNK_SIZE), b''):
+                chunks.append(self.put_chunk(data))
+        return chunks
+
+    def backup(self, proj_fld, name, rel_paths, on_done=None):
+        """Stores a project and records it as a manifest
+        :param proj_fld: text, the project folder
+        :param name: text, the name of the backup, e.g. project_171026073518
+        :param rel_paths: iterable of the paths we want to back up, relative to the project folder
+        :param on_done: (optional) function called with each relative path once it is stored
+        :return: The manifest
+        """
+        entries = []
+        for rel in rel_paths:
+            path = join(proj_fld, rel)
+            st = os.lstat(path)
+            entry = {'path': rel, 'mode': stat.S_IMODE(st.st_mode), 'mtime_ns': st.st_mtime_ns}
+            if stat.S_ISLNK(st.st_mode):
+                entry.update(type='symlink', target=os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entry.update(type='dir')
+            else:
+                entry.update(type='file', size=st.st_size, chunks=self.put_file(path))
+            entries.append(entry)
+            LOG.advance(1, entry.get('size', 0))
+            if on_done:
+                on_done(rel)
+        manifest = {'project': proj_fld, 'name': name, 'entries': entries}
+        tmp_path = join(self.path, 'manifests', f'{name}.json.tmp')
+        with open(tmp_path, 'w') as write_manifest:
+            json.dump(manifest, write_manifest)
+        os.replace(tmp_path, join(self.path, 'manifests', f'{name}.json'))
+        return manifest
+
+    def restore(self, name, dst):
+        """Rebuilds a project from one of its manifests
+        :param name: text, the name of the backup
+        :param dst: text, the folder where the project will be rebuilt
+        :return: The number of restored elements
+        :raise ValueError: if an entry of the manifest would be written outside of the destination folder
+        """
+        with open(join(self.path, 'manifests', f'{name}.json'), 'r') as read_manifest:
+            manifest = json.load(read_manifest)
+        os.makedirs(dst)
+        root = os.path.realpath(dst)
+        dirs = []
+        for entry in manifest['entries']:
+            path = join(dst, entry['path'])
+            # Absolute paths, '..' and the symbolic links restored before could all lead out of the folder
+            resolved = os.path.realpath(path)
+            if resolved == root or os.path.commonpath([root, resolved]) != root:
+                raise ValueError(f'the entry {entry["path"]} of the manifest is outside of {dst}')
+            if entry['type'] == 'dir':
+                os.makedirs(path, exist_ok=True)
+                dirs.append(entry)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if entry['type'] == 'symlink':
+                os.symlink(entry['target'], path)
+                continue
+            with open(path, 'wb') as write_file:
+                for digest in entry['chunks']:
+                    write_file.write(self.get_chunk(digest))
+            os.chmod(path, entry['mode'])
+            os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        # The folders are updated last, as writing their content changes their modification time
+        for entry in reversed(dirs):
+            path = join(dst, entry['path'])
+            os.chmod(path, entry['mode'])
+            os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        return len(manifest['entries'])
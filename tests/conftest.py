@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules of shlerp live at the root of the repository, next to main.py
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
@@ -0,0 +1,130 @@
+import os
+import stat
+import zipfile
+
+import pytest
+
+import archive
+
+
+def make_tree(root):
+    os.makedirs(f'{root}/src/empty')
+    with open(f'{root}/src/main.py', 'wb') as write_file:
+        write_file.write(b'print("shlerp")\n' * 10000)
+    with open(f'{root}/src/image.png', 'wb') as write_file:
+        write_file.write(os.urandom(300000))
+    # Bigger than a spool, so that it goes through a temporary file
+    with open(f'{root}/src/big.txt', 'wb') as write_file:
+        write_file.write(b'0123456789abcdef' * (archive.SPOOL_SIZE // 8))
+    open(f'{root}/src/empty.txt', 'wb').close()
+    os.symlink('main.py', f'{root}/src/link')
+    paths = []
+    for folder, dirs, files in os.walk(root):
+        for name in sorted(dirs + files):
+            paths.append(os.path.relpath(os.path.join(folder, name), root))
+    return paths
+
+
+def write_zip(path, root, paths, **kwargs):
+    with archive.ParallelZip(path, **kwargs) as zip_file:
+        for rel_path in paths:
+            zip_file.write(f'{root}/{rel_path}', rel_path)
+
+
+def test_round_trip(tmp_path):
+    root = tmp_path / 'project'
+    paths = make_tree(root)
+    path = tmp_path / 'project.zip'
+    # A small window makes the writer wait for the compression threads
+    write_zip(path, root, paths, level=6, threads=4, window=2, window_bytes=1024 * 1024)
+
+    with zipfile.ZipFile(path) as zip_file:
+        assert zip_file.testzip() is None
+        infos = {info.filename.rstrip('/'): info for info in zip_file.infolist()}
+        assert sorted(infos) == sorted(paths)
+        for rel_path, info in infos.items():
+            full_path = f'{root}/{rel_path}'
+            if os.path.islink(full_path):
+                assert stat.S_ISLNK(info.external_attr >> 16)
+                assert zip_file.read(info) == os.readlink(full_path).encode()
+            elif os.path.isdir(full_path):
+                assert info.is_dir()
+            else:
+                with open(full_path, 'rb') as read_file:
+                    assert zip_file.read(info) == read_file.read()
+        # Already compressed files are stored as they are
+        assert infos['src/image.png'].compress_type == zipfile.ZIP_STORED
+        assert infos['src/main.py'].compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_zip64_member(tmp_path):
+    # A sparse file doesn't take any room on the disk, and its zeros compress to almost nothing
+    big = tmp_path / 'big.bin'
+    with open(big, 'wb') as write_file:
+        write_file.truncate(archive.ZIP64_LIMIT + 4096)
+    small = tmp_path / 'small.txt'
+    small.write_bytes(b'after the zip64 member')
+    path = tmp_path / 'big.zip'
+    with archive.ParallelZip(path, level=1, threads=2) as zip_file:
+        zip_file.write(big, 'big.bin')
+        zip_file.write(small, 'small.txt')
+
+    with zipfile.ZipFile(path) as zip_file:
+        assert zip_file.getinfo('big.bin').file_size == archive.ZIP64_LIMIT + 4096
+        assert zip_file.read('small.txt') == b'after the zip64 member'
+        assert zip_file.testzip() is None
+
+
+def test_zip64_member_count(tmp_path):
+    folder = tmp_path / 'folder'
+    folder.mkdir()
+    st = os.lstat(folder)
+    path = tmp_path / 'many.zip'
+    count = archive.ZIP_FILECOUNT_LIMIT + 10
+    with archive.ParallelZip(path, threads=1) as zip_file:
+        for index in range(count):
+            zip_file.write(folder, f'd{index}', st=st)
+
+    with zipfile.ZipFile(path) as zip_file:
+        assert len(zip_file.infolist()) == count
+        assert zip_file.testzip() is None
+
+
+def test_failed_archive_is_not_finished(tmp_path):
+    small = tmp_path / 'small.txt'
+    small.write_bytes(b'written before the failure')
+    path = tmp_path / 'failed.zip'
+    with pytest.raises(RuntimeError), archive.ParallelZip(path, threads=1) as zip_file:
+        zip_file.write(small, 'small.txt')
+        raise RuntimeError
+    assert not zipfile.is_zipfile(path)
+
+
+def test_reuse_previous_members(tmp_path):
+    root = tmp_path / 'project'
+    paths = make_tree(root)
+    previous = tmp_path / 'previous.zip'
+    write_zip(previous, root, paths, level=6)
+    files = [rel_path for rel_path in paths if os.path.isfile(f'{root}/{rel_path}')
+             and not os.path.islink(f'{root}/{rel_path}')]
+
+    # Same size and modification time but another content: only the CRC tells them apart
+    main_py = root / 'src' / 'main.py'
+    st = os.stat(main_py)
+    main_py.write_bytes(main_py.read_bytes().replace(b'shlerp', b'SHLERP'))
+    os.utime(main_py, ns=(st.st_atime_ns, st.st_mtime_ns))
+    (root / 'src' / 'empty.txt').write_bytes(b'not empty anymore')
+
+    path = tmp_path / 'next.zip'
+    with archive.ParallelZip(path, level=6) as zip_file:
+        zip_file.reuse(previous)
+        for rel_path in paths:
+            zip_file.write(f'{root}/{rel_path}', rel_path)
+
+    # The pending members are only written, and counted, once the archive is closed
+    assert zip_file.reused == len(files) - 2
+    with zipfile.ZipFile(path) as zip_file:
+        assert zip_file.testzip() is None
+        for rel_path in files:
+            with open(f'{root}/{rel_path}', 'rb') as read_file:
+                assert zip_file.read(rel_path) == read_file.read()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import gitignore
+
+pytestmark = pytest.mark.skipif(not shutil.which('git'), reason='git is not installed')
+
+ROOT_RULES = r'''# comment
+*.log
+!keep.log
+/build
+dist/
+docs/**/*.tmp
+**/cache
+a?c.txt
+[]x]
+[!a-c]z.md
+\#literal
+trailing.txt
+sub/deep/
+'''
+SRC_RULES = '''*.txt
+!important.txt
+/local
+'''
+FILES = (
+    'keep.log', 'other.log', 'src/debug.log', 'build/out.o', 'src/build/kept.o', 'dist/app.js', 'src/dist/app.js',
+    'docs/a/b/c.tmp', 'docs/c.tmp', 'docs/c.md', 'w/cache/f', 'cache/g', 'abc.txt', 'adc.txt', ']', 'x', 'y',
+    'dz.md', 'az.md', '#literal', 'literal', 'trailing.txt', 'src/note.txt', 'src/important.txt', 'src/local/f',
+    'local/f', 'secret1', 'src/secret2', 'sub/deep/f', 'w/sub/deep/f', 'src/main.py',
+)
+
+
+def git_ignored(repo, paths):
+    done = subprocess.run(['git', 'check-ignore', '--stdin'], cwd=repo, input='\n'.join(paths),
+                          capture_output=True, text=True)
+    assert done.returncode in (0, 1), done.stderr
+    return set(done.stdout.splitlines())
+
+
+def test_same_as_git(tmp_path):
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    subprocess.run(['git', 'init', '-q'], cwd=repo, check=True)
+    (repo / '.gitignore').write_text(ROOT_RULES)
+    for rel_path in FILES:
+        path = repo / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    (repo / 'src' / '.gitignore').write_text(SRC_RULES)
+    (repo / '.git' / 'info' / 'exclude').write_text('secret*\n')
+
+    ignore = gitignore.GitIgnore(str(repo))
+    compared = 0
+    # Compared level by level, the content of an ignored folder being left out like the walks of shlerp do
+    folders = ['']
+    while folders:
+        rel_dir = folders.pop()
+        names = sorted(os.listdir(repo / rel_dir if rel_dir else repo))
+        paths = [f'{rel_dir}/{name}' if rel_dir else name for name in names if name != '.git']
+        ignored_by_git = git_ignored(repo, paths)
+        for rel_path in paths:
+            is_dir = os.path.isdir(repo / rel_path)
+            assert ignore.ignored(rel_path, is_dir) == (rel_path in ignored_by_git), rel_path
+            compared += 1
+            if is_dir and rel_path not in ignored_by_git:
+                folders.append(rel_path)
+    assert compared > len(FILES)
+
+
+@pytest.mark.parametrize('pattern, matched, unmatched', [
+    ('[]x]', (']', 'x'), ('y', '[]x]')),
+    ('[!]a]', ('b',), (']', 'a')),
+    ('[^a-c]z', ('dz',), ('az', 'bz')),
+    ('[.]', ('.',), ('a',)),
+    ('\\[a]', ('[a]',), ('a',)),
+])
+def test_bracket_sets(pattern, matched, unmatched):
+    (regex, _, _, _), = gitignore.parse([pattern])
+    for name in matched:
+        assert regex.fullmatch(name), name
+    for name in unmatched:
+        assert not regex.fullmatch(name), name
+
+
+def test_invalid_lines_are_skipped():
+    invalid = []
+    rules = gitignore.parse(['[z-a]', '*.log'], lambda line, exc: invalid.append(line))
+    assert invalid == ['[z-a]']
+    assert len(rules) == 1
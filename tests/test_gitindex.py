@@ -0,0 +1,77 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import gitindex
+
+pytestmark = pytest.mark.skipif(not shutil.which('git'), reason='git is not installed')
+
+# Paths sharing long prefixes, which the version 4 of the index compresses
+FILES = (
+    'README.md', 'src/main.py', 'src/main_test.py', 'src/utils/__init__.py', 'src/utils/strings.py',
+    'src/utils/strings_test.py', 'docs/é.md', f'deep/{"nested/" * 30}file.txt', 'a', 'ab', 'abc/d',
+)
+
+
+def git(repo, *args):
+    return subprocess.run(['git', *args], cwd=repo, check=True, capture_output=True, text=True).stdout
+
+
+def make_repo(root, version):
+    root.mkdir()
+    git(root, 'init', '-q')
+    for rel_path in FILES:
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f'content of {rel_path}\n')
+    os.symlink('README.md', root / 'link')
+    git(root, 'add', '.')
+    if version > 2:
+        # Intent-to-add entries have extended flags, which only the versions 3 and 4 can hold
+        (root / 'later.txt').write_text('added later\n')
+        git(root, 'add', '--intent-to-add', 'later.txt')
+    git(root, 'update-index', '--index-version', str(version))
+    return root
+
+
+def staged(repo):
+    """
+    :return: A dictionary mapping the paths of the index to their (mode, object name), as listed by git
+    """
+    entries = {}
+    for line in git(repo, '-c', 'core.quotePath=false', 'ls-files', '--stage', '-z').split('\0'):
+        if line:
+            info, path = line.split('\t', 1)
+            mode, sha1, _ = info.split()
+            entries[path] = (int(mode, 8), sha1)
+    return entries
+
+
+@pytest.mark.parametrize('version', [2, 3, 4])
+def test_parse(tmp_path, version):
+    repo = make_repo(tmp_path / 'repo', version)
+    with open(repo / '.git' / 'index', 'rb') as read_index:
+        data = read_index.read()
+    assert int.from_bytes(data[4:8], 'big') == version
+
+    entries = gitindex.parse(data)
+    assert {path: (entry.mode, entry.sha1) for path, entry in entries.items()} == staged(repo)
+    main_py = os.stat(repo / 'src' / 'main.py')
+    assert entries['src/main.py'].size == main_py.st_size
+    assert entries['src/main.py'].mtime_ns // 10 ** 9 == main_py.st_mtime_ns // 10 ** 9
+
+
+def test_tracked_folders(tmp_path):
+    repo = make_repo(tmp_path / 'repo', 2)
+    index = gitindex.Index(str(repo))
+    assert index.tracked('src/utils/strings.py')
+    assert index.tracked('src/utils')
+    assert index.tracked('deep/nested')
+    assert not index.tracked('untracked.txt')
+
+
+def test_not_an_index():
+    with pytest.raises(ValueError):
+        gitindex.parse(b'PK\x03\x04' + bytes(20))
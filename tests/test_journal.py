@@ -0,0 +1,69 @@
+import os
+import sys
+import shutil
+import subprocess
+
+import journal
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def shlerp(home, *args):
+    """Runs the CLI from a new interpreter, installed in a home folder of its own"""
+    env = dict(os.environ, HOME=str(home))
+    done = subprocess.run([sys.executable, os.path.join(REPO, 'main.py'), *args], env=env,
+                          capture_output=True, text=True)
+    assert done.returncode == 0, done.stdout + done.stderr
+    return done.stdout
+
+
+def install(home):
+    install_fld = home / '.local' / 'bin' / 'shlerp'
+    install_fld.mkdir(parents=True)
+    for name in ('rules.json', 'settings.json'):
+        shutil.copy(os.path.join(REPO, name), install_fld / name)
+
+
+def make_projects(src, names):
+    for name in names:
+        (src / name).mkdir(parents=True)
+        (src / name / 'package.json').write_text('{}')
+        (src / name / 'index.js').write_text(f'console.log("{name}");\n')
+
+
+def test_journal_last_state_wins(tmp_path):
+    run_journal = journal.Journal(str(tmp_path / 'journal'))
+    run_journal.start({'source': '/src'}, [{'project': '/src/a', 'state': 'pending', 'dst': '/out/a_1'}])
+    run_journal.write('/src/a', state='running', rule='Javascript')
+    run_journal.write('/src/a', state='done')
+    # An interrupted run may leave a line cut short
+    with open(tmp_path / 'journal', 'a') as write_journal:
+        write_journal.write('{"project": "/src/a", "sta')
+
+    run, projects = run_journal.read()
+    assert run == {'source': '/src'}
+    assert projects['/src/a'] == {'project': '/src/a', 'state': 'done', 'dst': '/out/a_1', 'rule': 'Javascript'}
+
+
+def test_resume_skips_done_projects(tmp_path):
+    home, src, out = tmp_path / 'home', tmp_path / 'src', tmp_path / 'out'
+    install(home)
+    make_projects(src, ('alpha', 'beta'))
+    out.mkdir()
+    shlerp(home, '-p', str(src), '-b', '-o', str(out))
+    run_journal = journal.Journal(str(out / journal.JOURNAL_NAME))
+    _, projects = run_journal.read()
+    assert {entry['state'] for entry in projects.values()} == {'done'}
+
+    # The backup of beta failed, alpha's one is kept as it is
+    alpha_backups = sorted(os.listdir(out))
+    beta_dst = projects[f'{src}/beta']['dst']
+    shutil.rmtree(beta_dst)
+    run_journal.write(f'{src}/beta', state='failed')
+
+    output = shlerp(home, '-p', str(src), '-b', '-o', str(out), '--resume')
+    assert f'Already backed up: {projects[f"{src}/alpha"]["dst"]}' in output
+    assert sorted(os.listdir(out)) == alpha_backups
+    assert (out / os.path.basename(beta_dst) / 'index.js').read_text() == 'console.log("beta");\n'
+    _, projects = run_journal.read()
+    assert {entry['state'] for entry in projects.values()} == {'done'}
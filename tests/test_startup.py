@@ -0,0 +1,12 @@
+import startup
+
+
+def test_startup_within_budget():
+    measures = startup.measure(runs=5)
+    added_ms = (measures['main'] - measures['click']) * 1000
+    assert added_ms <= startup.BUDGET_MS, f'importing main.py adds {added_ms:.1f}ms to importing click'
+
+
+def test_code_paths_imported_lazily():
+    measures = startup.measure(runs=1)
+    assert not [name for name in startup.LAZY_MODULES if name in measures['modules']]
@@ -0,0 +1,53 @@
+import os
+import json
+
+import pytest
+
+import store
+
+
+def write_manifest(shlerp_store, name, entries):
+    with open(os.path.join(shlerp_store.path, 'manifests', f'{name}.json'), 'w') as write_file:
+        json.dump({'project': '/nowhere', 'name': name, 'entries': entries}, write_file)
+
+
+def folder_entry(path):
+    return {'path': path, 'type': 'dir', 'mode': 0o755, 'mtime_ns': 0}
+
+
+def test_round_trip(tmp_path):
+    project = tmp_path / 'project'
+    (project / 'src').mkdir(parents=True)
+    (project / 'src' / 'main.py').write_bytes(b'print("shlerp")\n' * 100000)
+    (project / 'src' / 'copy.py').write_bytes(b'print("shlerp")\n' * 100000)
+    os.symlink('src/main.py', project / 'link')
+    shlerp_store = store.Store(str(tmp_path / 'store'))
+    shlerp_store.backup(str(project), 'project_1', ['src', 'src/main.py', 'src/copy.py', 'link'])
+    # Both files are made of the same chunks
+    assert shlerp_store.reused_chunks >= 2
+
+    restored = tmp_path / 'restored'
+    assert shlerp_store.restore('project_1', str(restored)) == 4
+    assert (restored / 'src' / 'main.py').read_bytes() == (project / 'src' / 'main.py').read_bytes()
+    assert os.readlink(restored / 'link') == 'src/main.py'
+
+
+@pytest.mark.parametrize('entries', [
+    [folder_entry('../outside')],
+    [folder_entry('src'), folder_entry('src/../../outside')],
+    [{'path': 'link', 'type': 'symlink', 'target': '..', 'mode': 0o777, 'mtime_ns': 0}, folder_entry('link/outside')],
+])
+def test_restore_rejects_paths_outside(tmp_path, entries):
+    shlerp_store = store.Store(str(tmp_path / 'store'))
+    write_manifest(shlerp_store, 'evil', entries)
+    with pytest.raises(ValueError):
+        shlerp_store.restore('evil', str(tmp_path / 'restored'))
+    assert not (tmp_path / 'outside').exists()
+
+
+def test_restore_rejects_absolute_paths(tmp_path):
+    shlerp_store = store.Store(str(tmp_path / 'store'))
+    write_manifest(shlerp_store, 'evil', [folder_entry(str(tmp_path / 'outside'))])
+    with pytest.raises(ValueError):
+        shlerp_store.restore('evil', str(tmp_path / 'restored'))
+    assert not (tmp_path / 'outside').exists()
@@ -1,13 +1,16 @@
 import os
-import random
-import subprocess
-from uuid import uuid4
-from datetime import datetime
 from os.path import exists
-from click import echo
-import click
-import glob
-import json
+import re
+import mmap
+import fnmatch
+from logs import LOG, timestamp
+
+# Characters that make an exclusion a glob pattern
+GLOB_CHARS = set('*?[')
+# Size of the chunks read by pattern_found() when a file can't be memory-mapped,
+# and how many bytes of the previous chunk are searched again for a regex
+PATTERN_CHUNK = 1024 * 1024
+PATTERN_OVERLAP = 4096
 
 
 # Common
@@ -30,49 +33,86 @@ def s_print(operation, lvl, message, *args, **kwargs):
             count = f'[{kwargs["cnt"]}]'
         if 'input' in kwarg:
             u_input = True
-    string = f"[{(f'{uid}:' if uid else '')}{get_dt()}:{operation}]{count}[{lvl}] {message}"
-    if lvl == 'I':
-        if not u_input:
-            echo(string)
-        else:
-            return input(string)
-    else:
-        color = None
-        if lvl == 'E':
-            color = 'red'
-        if lvl == 'W':
-            color = 'bright_yellow'
-        if not u_input:
-            echo(click.style(string, fg=color))
-        else:
-            return input(click.style(string, fg=color))
+    # In the quiet and progress modes, the informative messages are not even formatted unless they are logged
+    if not u_input and not LOG.shows(lvl):
+        return None
+    dt = timestamp()
+    string = f"[{(f'{uid}:' if uid else '')}{dt}:{operation}]{count}[{lvl}] {message}"
+    color = None
+    if lvl == 'E':
+        color = 'red'
+    if lvl == 'W':
+        color = 'bright_yellow'
+    if u_input:
+        LOG.flush()
+        import click
+        return input(click.style(string, fg=color) if color else string)
+    LOG.message(string, lvl, color, {
+        'time': dt, 'uid': uid, 'operation': operation, 'count': kwargs.get('cnt') or None, 'level': lvl,
+        'message': message
+    } if LOG.log_path else None)
+    return None
 
 
 def get_dt():
     """
-    :return: A timestamp in string format
+    :return: A timestamp in string format, computed once per second
     """
-    return str(datetime.now().strftime('%d%m%y%H%M%S'))
+    return timestamp()
 
 
 def suid():
     """Generates a short uid
     :return: A unique identifier with a fixed length of 6 characters
     """
-    chunks = str(uuid4()).split('-')
-    count = 0
-    uid = ''
-    while count < 3:
-        chunk = random.choice(chunks)
-        uid = f'{uid}{chunk[:2]}'
-        chunks.remove(chunk)
-        count += 1
-    return uid
+    # Same alphabet as the uuid4 chunks it used to be made of, without importing uuid and random at startup
+    return os.urandom(3).hex()
 
 
 # Shlerp script
 
 
+def new_summ():
+    """
+    :return: An empty summary
+    """
+    return {
+        'total': 0,
+        'done': 0,
+        'failed': 0,
+        'failures': [],
+        'ad_failures': [],
+        # project folder -> [rule name, fingerprint], for the detection cache
+        'detected': {}
+    }
+
+
+def job_summ(proj_fld, status):
+    """Builds the summary of a single backup job
+    :param proj_fld: text, the project folder that has been processed
+    :param status: 0 if the job succeeded, 1 if it failed
+    :return: A summary that only accounts for this job
+    """
+    summ = update_summ(new_summ(), status)
+    if status == 1:
+        summ['failures'].append(proj_fld)
+    return summ
+
+
+def merge_summ(summ, result):
+    """Adds the result of a job to the summary of the run
+    :param summ: The summary of the run
+    :param result: The summary of a single job
+    :return: The summary of the run
+    """
+    summ['done'] += result['done']
+    summ['failed'] += result['failed']
+    summ['failures'] += result['failures']
+    summ['ad_failures'] += result['ad_failures']
+    summ['detected'].update(result['detected'])
+    return summ
+
+
 def update_summ(summ, status):
     if status == 0:
         summ['done'] += 1
@@ -81,67 +121,206 @@ def update_summ(summ, status):
     return summ
 
 
-def iglob_hidden(*args, **kwargs):
-    """A glob.iglob that include dot files and hidden files"""
-    """The credits goes to the user polyvertex for this function"""
-    old_ishidden = glob._ishidden
-    glob._ishidden = lambda x: False
-    try:
-        yield from glob.iglob(*args, **kwargs)
-    finally:
-        glob._ishidden = old_ishidden
+def walk_hidden(path, prune=None, onerror=None):
+    """A recursive walk that includes dot files and hidden files. It is built on os.scandir and doesn't
+    rely on any global state, so it can run from many threads at once
+    :param path: text, the folder we want to walk
+    :param prune: (optional) function called with (relative path, is_dir), returning True to skip an element.
+    The content of a skipped folder is never listed
+    :param onerror: (optional) function called with the OSError raised when a folder can't be listed.
+    The walk goes on afterwards, without it the error is raised
+    :return: A generator of (relative path, os.DirEntry) tuples, each folder coming before its content
+    """
+    stack = ['']
+    while stack:
+        rel_fld = stack.pop()
+        try:
+            entries = os.scandir(f'{path}/{rel_fld}' if rel_fld else path)
+        except OSError as exc:
+            if not onerror:
+                raise
+            onerror(exc)
+            continue
+        with entries:
+            for entry in entries:
+                rel_name = f'{rel_fld}/{entry.name}' if rel_fld else entry.name
+                is_dir = entry.is_dir()
+                if prune and prune(rel_name, is_dir):
+                    continue
+                yield rel_name, entry
+                # Symbolic links to folders are yielded as links, their target isn't walked
+                if is_dir and not entry.is_symlink():
+                    stack.append(rel_name)
+
+
+class ExclusionMatcher:
+    """Decides which elements of a project are left out of the backup. Built once per project out of the
+    exclusions of its rule and the options, it only needs a few set lookups per path component and caches
+    the decision taken for each folder.
+    Exclusions are matched against whole names: "venv" excludes "venv" and "a/venv" but not "myvenv".
+    Folder exclusions containing a "/" (e.g. "gradle/wrapper") are matched from the root of the project,
+    and names containing wildcards (e.g. "*.log") are matched as globs.
+    With a GitIgnore object, the elements ignored by the .gitignore files of the project are excluded as well.
+    """
+
+    def __init__(self, exclusions, options, exclude_dep=True, gitignore=None, hidden='all'):
+        """
+        :param exclusions: Dictionary containing the files and folders we want to exclude
+        :param options: dictionary/object containing exclusion options
+        :param exclude_dep: (optional) also exclude the dependency folder of the rule
+        :param gitignore: (optional) gitignore.GitIgnore object, the elements ignored by git are excluded too
+        :param hidden: (optional) which hidden elements are excluded: 'all' of them, only the 'top' level ones,
+        or None. Copies only leave out the top-level ones, as they always did
+        """
+        folders = [] if options['noexcl'] else list(exclusions['folders'])
+        files = [] if options['noexcl'] else list(exclusions['files'])
+        if exclude_dep and exclusions['dep_folder']:
+            folders.append(exclusions['dep_folder'])
+        if options['nogit']:
+            folders.append('.git')
+            files.append('.gitignore')
+        self.keephidden = options['keephidden']
+        self.hidden = hidden
+        # Git data is kept along with the other hidden elements, unless --nogit is used
+        self.hidden_allowed = set() if options['nogit'] else {'.git', '.gitignore'}
+
+        self.folder_names = set()
+        self.file_names = set()
+        folder_globs, folder_paths, file_globs = [], [], []
+        for folder in folders:
+            folder = folder.strip('/')
+            if '/' in folder:
+                folder_paths.append(fnmatch.translate(folder)[:-2] + r'(?:/|\Z)')
+            elif set(folder) & GLOB_CHARS:
+                folder_globs.append(fnmatch.translate(folder))
+            else:
+                self.folder_names.add(folder)
+        for file in files:
+            if set(file) & GLOB_CHARS:
+                file_globs.append(fnmatch.translate(file))
+            else:
+                self.file_names.add(file)
+        self.folder_glob = re.compile('|'.join(folder_globs)) if folder_globs else None
+        self.folder_path = re.compile('|'.join(folder_paths)) if folder_paths else None
+        self.file_glob = re.compile('|'.join(file_globs)) if file_globs else None
+        # relative folder path -> excluded or not
+        self.cache = {'': False}
+        # kind of exclusion -> number of elements it has left out, see exclusion_reason()
+        self.skipped = {}
+        self.gitignore = gitignore
+
+    def exclusion_reason(self, name, is_dir, top=True):
+        """
+        :param name: text, the name of a file or folder, without its path
+        :param is_dir: True if the element is a folder
+        :param top: (optional) False if the element is below a top-level folder of the project
+        :return: The kind of exclusion matched by the name alone, None if the name isn't excluded
+        """
+        if name.startswith('.') and not self.keephidden and name not in self.hidden_allowed and \
+                (self.hidden == 'all' or (self.hidden == 'top' and top)):
+            return 'hidden'
+        if is_dir:
+            if name in self.folder_names:
+                return 'folder'
+            if self.folder_glob and self.folder_glob.match(name):
+                return 'folder_glob'
+        elif name in self.file_names:
+            return 'file'
+        elif self.file_glob and self.file_glob.match(name):
+            return 'file_glob'
+        return None
+
+    def name_excluded(self, name, is_dir, top=True):
+        """
+        :param name: text, the name of a file or folder, without its path
+        :param is_dir: True if the element is a folder
+        :param top: (optional) False if the element is below a top-level folder of the project
+        :return: True if the name alone is enough to exclude the element
+        """
+        reason = self.exclusion_reason(name, is_dir, top)
+        if reason:
+            self.skipped[reason] = self.skipped.get(reason, 0) + 1
+        return bool(reason)
 
+    def dir_excluded(self, rel_dir):
+        """
+        :param rel_dir: text, the path of a folder, relative to the project folder
+        :return: True if the folder or one of its parents is excluded
+        """
+        excluded = self.cache.get(rel_dir)
+        if excluded is None:
+            parent, _, name = rel_dir.rpartition('/')
+            excluded = self.dir_excluded(parent) or self.name_excluded(name, True, not parent)
+            if not excluded and self.folder_path and self.folder_path.match(rel_dir):
+                self.skipped['folder_path'] = self.skipped.get('folder_path', 0) + 1
+                excluded = True
+            if not excluded and self.gitignore and self.gitignore.ignored(rel_dir, True):
+                self.skipped['gitignore'] = self.skipped.get('gitignore', 0) + 1
+                excluded = True
+            self.cache[rel_dir] = excluded
+        return excluded
 
-def get_files(path, exclusions, options):
-    """Lists the files contained in a given folder, without symlinks
+    def excluded(self, rel_path, is_dir=False):
+        """
+        :param rel_path: text, the path of an element, relative to the project folder
+        :param is_dir: True if the element is a folder
+        :return: True if the element has to be left out of the backup
+        """
+        if is_dir:
+            return self.dir_excluded(rel_path)
+        parent, _, name = rel_path.rpartition('/')
+        if self.dir_excluded(parent) or self.name_excluded(name, False, not parent):
+            return True
+        if self.gitignore and self.gitignore.ignored(rel_path):
+            self.skipped['gitignore'] = self.skipped.get('gitignore', 0) + 1
+            return True
+        return False
+
+
+def get_files(path, matcher):
+    """Lists the top-level elements of a given folder that aren't excluded
     :param path: String referring to the path that needs it's content to be listed
-    :param exclusions: Dictionary containing the files and folders we want to exclude
-    :param options: dictionary/object containing exclusion options
+    :param matcher: ExclusionMatcher built for the project
     :return: A list of files, without any possible node_modules folder
     """
-    if options['nogit']:
-        exclusions['folders'].append('.git')
-        exclusions['files'].append('.gitignore')
-    if options['noexcl']:
-        return [
-            file for file in os.listdir(path)
-            if (exclusions['dep_folder'] and file != exclusions['dep_folder'])
-            or not exclusions['dep_folder']
-        ]
-    elem_list = []
-    dep_fld = exclusions['dep_folder']
-    for elem in os.listdir(path):
-        excl_matched = False
-        if (
-            not options['keephidden'] and
-            elem.startswith('.') and
-            not (
-                elem == '.git' or
-                elem == '.gitignore'
-            )
-        ):
-            excl_matched = True
-        if os.path.isdir(f'{path}/{elem}'):
-            if exclusions['folders']:
-                for fld_excl in exclusions['folders']:
-                    if fld_excl in elem:
-                        excl_matched = True
-                        break
-            if dep_fld and dep_fld in elem:
-                excl_matched = True
-            if not excl_matched:
-                elem_list.append(elem)
-        else:
-            if exclusions['files']:
-                for file_excl in exclusions['files']:
-                    if file_excl in elem:
-                        excl_matched = True
-                        break
-            if dep_fld and dep_fld in elem:
-                excl_matched = True
-            if not excl_matched:
-                elem_list.append(elem)
-    return elem_list
+    return [elem for elem in os.listdir(path) if not matcher.excluded(elem, os.path.isdir(f'{path}/{elem}'))]
+
+
+def pattern_found(path, pattern, limit=None):
+    """Searches a pattern in the content of a file, without reading it line by line.
+    The file is memory-mapped when possible, read by overlapping chunks otherwise, and the search stops at the first match
+    :param path: text, the file we want to search
+    :param pattern: bytes for a plain substring, or a compiled bytes regex
+    :param limit: (optional) number of bytes of the file that are searched, from its beginning
+    :return: True if the pattern has been found
+    """
+    is_regex = not isinstance(pattern, bytes)
+    with open(path, 'rb') as read_file:
+        size = os.fstat(read_file.fileno()).st_size
+        end = min(size, limit) if limit else size
+        if end <= 0:
+            return False
+        try:
+            with mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                if is_regex:
+                    return pattern.search(content, 0, end) is not None
+                return content.find(pattern, 0, end) != -1
+        except (OSError, ValueError):
+            pass
+        # The overlap makes sure that a match spanning two chunks is found
+        overlap = PATTERN_OVERLAP if is_regex else len(pattern) - 1
+        tail = b''
+        read = 0
+        while read < end:
+            chunk = read_file.read(min(PATTERN_CHUNK, end - read))
+            if not chunk:
+                break
+            read += len(chunk)
+            window = tail + chunk
+            if (pattern.search(window) if is_regex else pattern in window):
+                return True
+            tail = window[-overlap:] if overlap > 0 else b''
+    return False
 
 
 def weight_found(leads):
@@ -171,77 +350,47 @@ def elect(leads):
     return None if len(winner) == 0 else winner
 
 
-def crawl_for_weight(proj_fld, leads):
+def ext_histogram(proj_fld, pruned):
+    """Walks the project once and counts the files per extension
+    :param proj_fld: text, the folder we want to process
+    :param pruned: set of folder names we don't want to descend into
+    :return: a dictionary mapping an extension (e.g. '.py') to a number of files
+    """
+    def prune(rel_name, is_dir):
+        # Hidden elements are skipped, the same way glob does it
+        name = rel_name.rpartition('/')[2]
+        return name.startswith('.') or (is_dir and name in pruned)
+
+    histogram = {}
+    # The folders that can't be listed are simply not counted
+    for _, entry in walk_hidden(proj_fld, prune, onerror=lambda exc: None):
+        if not entry.is_dir():
+            ext = os.path.splitext(entry.name)[1]
+            if ext:
+                histogram[ext] = histogram.get(ext, 0) + 1
+    return histogram
+
+
+def crawl_for_weight(proj_fld, leads, pruned=()):
     """Crawl the project to find files matching the extensions we provide to this function
     :param proj_fld: text, the folder we want to process
     :param leads: object list containing languages names, extensions to crawl and weights
+    :param pruned: (optional) folder names that won't be crawled, usually the dependency folders
     :return: an updated list with some more weight (hopefully)
     """
+    histogram = ext_histogram(proj_fld, set(pruned))
     for lead in leads:
+        # "crawl_limit" caps the number of files that can be counted for a single rule
+        remaining = lead['detect'].get('crawl_limit')
         for ext in lead['extensions']:
-            for _ in glob.iglob(f'{proj_fld}/**/{ext["name"]}', recursive=True):
-                lead['total'] += ext['weight']
+            matches = histogram.get(ext['name'][1:], 0)
+            if remaining is not None:
+                matches = min(matches, remaining)
+                remaining -= matches
+            lead['total'] += matches * ext['weight']
     return leads
 
 
-def enforce_limit(tmp_file, settings):
-    """Shortens the history if it is too long compared to history_limit
-    :param tmp_file: Temporary file containing the history list
-    :param settings: Param representing
-    :return:
-    """
-    history = tmp_file['rules_history']
-    history_limit = settings['rules']['history_limit']
-    if len(history) > history_limit:
-        history = history[:history_limit]
-        with open('tmp.json', 'w') as write_tmp:
-            tmp_file['rules_history'] = history
-            write_tmp.write(json.dumps(tmp_file, indent=4))
-
-
-def history_updated(rule, settings, tmp_file):
-    """Updates the history with a new rule
-    :param rule:  List of objects representing potential winners
-    :param settings: The settings of the project
-    :param tmp_file:
-    :return: A boolean depending on the outcome of this function
-    """
-    current_lang = rule['name']
-    try:
-        enforce_limit(tmp_file, settings)
-        history = tmp_file['rules_history']
-        history_limit = settings['rules']['history_limit']
-        # If the current language is in the history
-        if current_lang in history:
-            # But it's not the latest, get its position and remove it to add it back in first pos
-            if history.index(current_lang) != 0:
-                current_pos = history.index(current_lang)
-                history.pop(current_pos)
-                history.insert(0, current_lang)
-                with open(f'{os.getcwd()}/tmp.json', 'w') as write_tmp:
-                    tmp_file['rules_history'] = history
-                    write_tmp.write(json.dumps(tmp_file, indent=4))
-                    return True
-            return True
-        else:
-            # If the current language isn't in the list, remove the oldest one if needed and then add it
-            if len(history) == history_limit:
-                history.pop()
-            history.insert(0, current_lang)
-            tmp_file['rules_history'] = history
-            with open('tmp.json', 'w') as write_tmp:
-                write_tmp.write(json.dumps(tmp_file, indent=4))
-                return True
-    except (FileNotFoundError, ValueError):
-        with open(f'{os.getcwd()}/tmp.json', 'a') as write_tmp:
-            write_tmp.write(json.dumps({
-                "rules_history": [current_lang]
-            }))
-            if exists(f'{os.getcwd()}/tmp.json'):
-                return True
-    return False
-
-
 # Setup script
 
 def req_installed(setup_folder):
@@ -249,6 +398,7 @@ def req_installed(setup_folder):
     :param setup_folder: str representing the setup folder
     :return: True if it worked, else False
     """
+    import subprocess
     try:
         venv_bin = f'{setup_folder}venv/bin/'
         pip_path = f'{venv_bin}pip'